@@ -20,11 +20,12 @@
 
 # Utilities
 from .utils import zipboth
+from .kernels import detectAll, countAll, withinRadius, overlapMatrix, advanceAndDetect
 
 # Agents, targets, and sensors
-from .position import Position, Direction, haveSameDimensions, vectorPosition, distanceBetween, BoundingBox, Trajectory
+from .position import Position, Direction, haveSameDimensions, vectorPosition, distance2d, distance3d, distanceBetween, distanceSquaredBetween, BoundingBox, Trajectory, TrajectoryArray
 from .modalities import Modality, Targetting, TargetCount, TargetDistance, TargetDirection, TargetTrigger
-from .sensor import Sensor, SimpleTargetCountSensor
+from .sensor import Sensor, SimpleTargetCountSensor, SensorArray
 from .agent import Agent, MobileAgent
 
 # Playgrounds
@@ -20,7 +20,7 @@
 
 import numpy
 from typing import List, Union, Any, Dict, Iterable, Set, cast
-from sensorplayground import Position, BoundingBox, distanceBetween, Trajectory, Sensor
+from sensorplayground import Position, vectorPosition, BoundingBox, distanceBetween, Trajectory, Sensor
 
 # There is a circular import between Agent and SensorPlayground at the
 # typing level (but not at the execution level), when providing types
@@ -59,6 +59,7 @@ class Agent:
 
         # positional state
         self._position: Position = None
+        self._positionVector: numpy.ndarray = None
 
         # attached sensors
         self._sensors: Set['Sensor'] = set()
@@ -102,6 +103,8 @@ class Agent:
 
         # set the sensor's agent
         s.setAgent(self)
+        if self._playground is not None:
+            self._playground.sensorAdded(s)
 
 
     def removeSensor(self, sid: Union[Sensor, Any]):
@@ -116,6 +119,8 @@ class Agent:
         # remove the agent
         self._sensors.remove(s)
         del self._sensorIds[id]
+        if self._playground is not None:
+            self._playground.sensorRemoved(s)
 
 
     def sensors(self) -> Iterable[Sensor]:
@@ -134,6 +139,14 @@ class Agent:
         return self._position
 
 
+    def positionVector(self) -> numpy.ndarray:
+        '''Returns the agent's position as a numpy vector. The
+        conversion happens once, when the position is set.
+
+        :returns: the agent's position'''
+        return self._positionVector
+
+
     def isMoving(self) -> bool:
         '''test if the agent is moving. This is always False for "normal" agents.
 
@@ -165,6 +178,7 @@ class Agent:
 
         :param p: the position'''
         self._position = p
+        self._positionVector = None if p is None else vectorPosition(p)
         if p is None:
             self.playground().removeAgentBoundingBox(self)
         else:
@@ -255,6 +269,17 @@ class MobileAgent(Agent):
             return super().position()
 
 
+    def positionVector(self) -> numpy.ndarray:
+        '''Return the agent's position as a numpy vector. For a
+        moving agent this is computed from its trajectory.
+
+        :returns: the agent's position'''
+        if self.isMoving():
+            return vectorPosition(self.position())
+        else:
+            return super().positionVector()
+
+
     def setTrajectory(self, j: Trajectory):
         '''Set the trajectory being followed by the agent. This
         posts :meth:`startMotion` and :meth:`endMotion` events
@@ -263,8 +288,8 @@ class MobileAgent(Agent):
         :param j: the trajectory'''
         self._trajectory = j
         (st, et) = j.interval()
-        self.playground().postEvent(st, self, s.startMotion)
-        self.playground().postEvent(et, self, s.endMotion)
+        self.playground().postEvent(self, st, self.startMotion)
+        self.playground().postEvent(self, et, self.endMotion)
 
 
     def isMoving(self, fatal = False) -> bool:
@@ -315,11 +340,11 @@ class MobileAgent(Agent):
 
             # entry
             t = j.entersAt(ab)
-            self.playground().postEvent(t, a, a.enters)
+            self.playground().postEvent(a, t, a.enters)
 
             # exit
             t = j.exitsAt(ab)
-            self.playground().postEvent(t, a, a.leaves)
+            self.playground().postEvent(a, t, a.leaves)
 
 
     def endMotion(self):
@@ -0,0 +1,55 @@
+# Ahead-of-time compilation of the bulk sensing kernels
+#
+# Copyright (C) 2024 Simon Dobson
+#
+# This file is part of sensor-playground, an experimental framework for
+# target counting and higher-order sensor data analytics
+#
+# This is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This software is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this software. If not, see <http://www.gnu.org/licenses/gpl.html>.
+
+# This script compiles serial versions of the kernels in kernels.py
+# into an extension module, sensorplayground._kernels, which is then
+# used in preference to the JIT-compiled kernels for small inputs.
+# This avoids paying the JIT compilation cost in every process. Only
+# the build needs Numba: the compiled module only needs numpy.
+#
+# The kernels are compiled from the Python source of the JIT-compiled
+# kernels, so that the two can't drift apart. Without parallel
+# compilation their prange loops are ordinary loops.
+#
+# Run it from the top level of the repo with "make kernels" (or
+# "python -m sensorplayground.build_kernels").
+
+import os
+from numba.pycc import CC
+from sensorplayground import kernels
+
+
+def build():
+    '''Compile the kernels into the _kernels extension module,
+    alongside this file. Each kernel is exported in single- and
+    double-precision versions, suffixed by the type of their
+    floating-point arguments.'''
+    cc = CC('_kernels')
+    cc.output_dir = os.path.dirname(os.path.abspath(__file__))
+    for t in ['f4', 'f8']:
+        for d in [2, 3]:
+            cc.export(f'detectAll{d}_{t}', f'b1[:, :]({t}[:, :], {t}[:], {t}[:, :])')(getattr(kernels, f'_detectAll{d}Numba').py_func)
+            cc.export(f'countAll{d}_{t}', f'i8[:]({t}[:, :], {t}[:], {t}[:, :])')(getattr(kernels, f'_countAll{d}Numba').py_func)
+        cc.export(f'overlapMatrix_{t}', f'b1[:, :]({t}[:, :], {t}[:])')(kernels._overlapMatrixNumba.py_func)
+    cc.compile()
+
+
+if __name__ == '__main__':
+    build()
@@ -18,8 +18,10 @@
 # You should have received a copy of the GNU General Public License
 # along with this software. If not, see <http://www.gnu.org/licenses/gpl.html>.
 
+import numpy
 import matplotlib.pyplot as plt
 from matplotlib.patches import Circle
+from matplotlib.collections import PatchCollection
 from typing import Iterable
 from sensorplayground import Agent, Position
 
@@ -82,50 +84,56 @@ def drawField(ss: Iterable[Agent], ts: Iterable[Position] = None,
         subfieldWH = [1.0 - subfieldXY[0], 1.0 - subfieldXY[1]]
 
     # sensors, fields, and labels
-    if showSensors:
-        for s in ss:
-            p = s.position()
-
-            # mark sensor field
-            if showSensorFields:
-                c = Circle(p, radius=s.detectionRadius(),
-                           color=sensorFieldColour, alpha=sensorFieldAlpha)
-                ax.add_patch(c)
-
-            # determine sensor marker colour
-            if sensorFilled:
-                if sensorFillColour is None:
-                    # default colour os red
-                    col = 'r'
-                elif type(sensorFillColour) is dict:
-                    # extract colour from the dict, defaults to unfilled
+    ss = list(ss)
+    if showSensors and len(ss) > 0:
+        ps = numpy.asarray([s.position() for s in ss])
+
+        # mark sensor fields
+        if showSensorFields:
+            cs = [Circle(p, radius=s.detectionRadius()) for (s, p) in zip(ss, ps)]
+            ax.add_collection(PatchCollection(cs,
+                                              facecolor=sensorFieldColour, edgecolor=sensorFieldColour,
+                                              alpha=sensorFieldAlpha))
+
+        # determine sensor marker colours
+        if sensorFilled:
+            if sensorFillColour is None:
+                # default colour os red
+                cols = 'r'
+            elif type(sensorFillColour) is dict:
+                # extract colours from the dict, defaults to unfilled
+                cols = []
+                for s in ss:
                     col = sensorFillColour.get(s.id(), 'None')
                     if col is None:
                         col = 'None'   # matplotlib uses a string for unfilled
-                else:
-                    # use the literal colour provided
-                    col = sensorFillColour
+                    cols.append(col)
             else:
-                # leave unfilled
-                col = 'None'
-
-            # mark sensor position
-            ax.plot(p[0], p[1],
-                    color=sensorColour, marker=sensorMarker, markersize=sensorSize,
-                    markerfacecolor=col)
-
-            # add sensor label
-            if showSensorLabels:
-                ax.annotate(f'{s.id()}', s.position(),
+                # use the literal colour provided
+                cols = sensorFillColour
+        else:
+            # leave unfilled
+            cols = 'None'
+
+        # mark sensor positions
+        ax.scatter(ps[:, 0], ps[:, 1],
+                   marker=sensorMarker, s=sensorSize ** 2,
+                   edgecolors=sensorColour, facecolors=cols)
+
+        # add sensor labels
+        if showSensorLabels:
+            for (s, p) in zip(ss, ps):
+                ax.annotate(f'{s.id()}', p,
                             [1.1 * sensorSize, -1.1 * sensorSize], textcoords='offset pixels',
                             fontsize=sensorLabelFontSize, color=sensorLabelColour)
 
     # targets
     if showTargets and ts is not None:
         # positions
-        for t in ts:
-            ax.plot([t[0]], [t[1]],
-                    color=targetColour, marker=targetMarker, markersize=targetSize)
+        qs = numpy.asarray(ts)
+        if len(qs) > 0:
+            ax.scatter(qs[:, 0], qs[:, 1],
+                       marker=targetMarker, s=targetSize ** 2, c=targetColour)
 
     # counts
     if showCount and ts is not None:
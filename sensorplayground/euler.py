@@ -18,9 +18,12 @@
 # You should have received a copy of the GNU General Public License
 # along with this software. If not, see <http://www.gnu.org/licenses/gpl.html>.
 
-from itertools import combinations
-from typing import Iterable, Dict, cast
-from sensorplayground import Sensor, TargetCount, SensorPlayground, Position
+import numpy
+import networkx
+from scipy.spatial import cKDTree
+from itertools import combinations, chain, product
+from typing import Iterable, Dict, Set, Tuple
+from sensorplayground import Sensor, TargetCount, SensorPlayground, Position, countAll
 from simplicial import SimplicialComplex, Simplex, SimplicialFunction, InferredSFRepresentation, EulerIntegrator
 
 
@@ -78,6 +81,10 @@ class EulerEstimator:
     '''
 
 
+    KDTREE_THRESHOLD = 50    #: Number of sensors above which neighbour searches use a k-d tree.
+    GRID_RADIUS_RATIO = 2.0  #: Largest ratio of sensor radii for which target searches use a grid.
+
+
     def __init__(self, pg: SensorPlayground, sf: SimplicialFunction[int] = None):
         self._playground = pg
         if sf is None:
@@ -86,6 +93,8 @@ class EulerEstimator:
         self._c = self._build()
 
 
+    # ---------- Overhearing structure ----------
+
     def _build(self) -> SimplicialComplex:
         '''Build the overhearing structure for a set of sensors.
 
@@ -98,41 +107,52 @@ class EulerEstimator:
         c = SimplicialComplex()
 
         # extract the target counters
-        ss = self._playground.allSensorsWithModality(TargetCount)
+        ss = list(self._playground.allSensorsWithModality(TargetCount))
+        ids = [s.id() for s in ss]
 
         # add the basis, using the sensors' ids as simplex names
-        for s in ss:
-            c.addSimplex(id=s.id())
-
-        # add higher simplices
-        for k in range(1, len(ss)):
-            # track now many k-simplices we create
-            created = 0
-
-            # run through all combinations of (k + 1) basis simplices
-            for pb in combinations(ss, k + 1):
-                pairwise = True
-
-                # check all pairwise distances
-                for (i, j) in combinations(pb, 2):
-                    if not i.isOverlappingWith(j):
-                        # pair is not overlapping, so can't create
-                        # a k-simplex from this basis
-                        pairwise = False
-                        break
-
-                # if all the pairwise distances were overlapping,
-                # create the higher simplex on this basis
-                if pairwise:
-                    bs = [s.id() for s in pb]
-                    c.addSimplexWithBasis(bs)
-                    created += 1
-
-            # if we created enough k-simplices to potentially build
-            # a (k + 1)-simplex, carry on; otherwise we can't build any
-            # higher simplices, and so can escape from the loop
-            if created < (k + 1) + 1:
-                break
+        for id in ids:
+            c.addSimplex(id=id)
+
+        # snapshot the sensors' positions and radii from the playground's
+        # sensor arrays, which we keep so that we can later update the
+        # structure incrementally. These are held in double precision
+        # whatever the precision of the playground, so that all the
+        # overlap tests are made in the same way
+        self._sensors = ss
+        self._ids = ids
+        self._indices = {id: i for (i, id) in enumerate(ids)}
+        rows = [self._playground.sensorIndex(s) for s in ss]
+        self._P = self._playground.sensorPositions()[rows].astype(numpy.float64)
+        self._R = self._playground.sensorRadii()[rows].astype(numpy.float64)
+        self._tree = None
+        self._moved = set()
+
+        # the counts observed at each sensor, by index
+        self._counts = numpy.zeros(len(ss), dtype=numpy.int32)
+        self._countsChanged = True
+
+        # find all the pairwise overlaps at once, and turn them
+        # into neighbour sets for each sensor
+        self._g = networkx.Graph()
+        self._g.add_nodes_from(range(len(ss)))
+        self._g.add_edges_from(self._overlappingPairs().tolist())
+
+        # A set of sensors is a simplex exactly when its sensors
+        # mutually overlap, i.e., when it's a clique in the overlap
+        # graph. Every such set is a subset of some maximal clique,
+        # so we enumerate the maximal cliques and take all their
+        # subsets, de-duplicating those shared between cliques
+        bases = set()
+        for clique in networkx.find_cliques(self._g):
+            clique.sort()
+            for k in range(2, len(clique) + 1):
+                bases.update(combinations(clique, k))
+
+        # add higher simplices, lowest orders first
+        for pb in sorted(bases, key=len):
+            bs = [ids[i] for i in pb]
+            c.addSimplexWithBasis(bs)
 
         # set the overhearing structure as the complex underlying the height function
         self._f.setComplex(c)
@@ -141,28 +161,268 @@ class EulerEstimator:
         return c
 
 
+    def _overlaps(self, i: numpy.ndarray, j: numpy.ndarray) -> numpy.ndarray:
+        '''Test whether the fields of pairs of sensors overlap. Fields
+        that only touch don't overlap.
+
+        This is the only overlap test used by the estimator, whether
+        building the structure or updating it, so that the two always
+        agree for sensors that are close to touching.
+
+        :param i: the indices of the first sensors in each pair (or a single index)
+        :param j: the indices of the second sensors in each pair
+        :returns: a boolean array, True where the pair overlaps'''
+        diff = self._P[j] - self._P[i]
+        d2 = numpy.einsum('ij,ij->i', diff, diff)
+        rsum = self._R[i] + self._R[j]
+        return d2 < rsum * rsum
+
+
+    def _overlappingPairs(self) -> numpy.ndarray:
+        '''Return the pairs of sensors whose fields overlap.
+
+        For large numbers of sensors the candidate pairs are found
+        using a k-d tree, as those sensors within twice the largest
+        radius of each other, and then refined using their actual
+        radii. Smaller numbers of sensors are tested exhaustively,
+        taking all the pairs in the upper triangle of the (condensed)
+        pairwise matrix at once.
+
+        :returns: an (E, 2) array of sensor indices, with i < j in each pair'''
+        n = len(self._sensors)
+        if n >= self.KDTREE_THRESHOLD:
+            self._buildProximityIndex()
+            pairs = self._tree.query_pairs(2 * self._maxRadius(), output_type='ndarray')
+            pairs = self._treeRows[pairs].reshape((-1, 2))
+            return pairs[self._overlaps(pairs[:, 0], pairs[:, 1])]
+        elif n > 0:
+            (i, j) = numpy.triu_indices(n, 1)
+            overlaps = self._overlaps(i, j)
+            return numpy.column_stack((i[overlaps], j[overlaps]))
+        else:
+            return numpy.empty((0, 2), dtype=int)
+
+
+    def _isPlaced(self, i: int) -> bool:
+        '''Test whether a sensor has a position and radius, and
+        so can overlap with other sensors.
+
+        :param i: the sensor index
+        :returns: True if the sensor's position and radius are finite'''
+        return bool(numpy.isfinite(self._P[i]).all() and numpy.isfinite(self._R[i]))
+
+
+    def _maxRadius(self) -> float:
+        '''Return the largest radius of any sensor, ignoring sensors
+        without radii.
+
+        :returns: the radius'''
+        return float(self._R[numpy.isfinite(self._R)].max(initial=0.0))
+
+
+    def _buildProximityIndex(self):
+        '''Build the k-d tree over the sensors' current positions.
+
+        Sensors without positions or radii (which are NaNs in the
+        playground's sensor arrays) can't overlap with anything, and
+        are left out of the tree. The indices of the points in the
+        tree are mapped back to sensor indices using _treeRows.'''
+        placed = numpy.isfinite(self._P).all(axis=1) & numpy.isfinite(self._R)
+        self._treeRows = numpy.nonzero(placed)[0]
+        self._tree = cKDTree(self._P[placed])
+        self._moved = set()
+
+
+    def _candidatesNear(self, i: int) -> Iterable[int]:
+        '''Return the indices of all sensors that might overlap with
+        the given sensor. These are the sensors whose positions when
+        the k-d tree was built lie within the sum of its radius and the
+        largest radius, together with any that have moved since.
+
+        :param i: the sensor index
+        :returns: the candidate indices'''
+        if not self._isPlaced(i):
+            return set()
+        if self._tree is None:
+            self._buildProximityIndex()
+        ks = self._tree.query_ball_point(self._P[i], self._R[i] + self._maxRadius())
+        js = set(self._treeRows[numpy.asarray(ks, dtype=int)].tolist())
+        js.update(self._moved)
+        js.discard(i)
+        return js
+
+
+    def _updateMovedSensors(self):
+        '''Update the overhearing structure for any sensors that have
+        moved since it was last built or updated. The moved sensors are
+        found by comparing the positions in our snapshot against those
+        in the playground's sensor arrays.'''
+        pg = self._playground
+        rows = [pg.sensorIndex(s) for s in self._sensors]
+        ps = pg.sensorPositions()[rows]
+        changed = (ps != self._P) & ~(numpy.isnan(ps) & numpy.isnan(self._P))
+        for i in numpy.nonzero(changed.any(axis=1))[0].tolist():
+            self.updateSensor(self._sensors[i])
+
+
+    def updateSensor(self, s: Sensor):
+        '''Update the overhearing structure after a sensor has moved.
+
+        Rather than rebuilding the whole complex, this re-computes
+        only the overlaps between the given sensor and its neighbours,
+        and then only if its set of neighbours has changed. The
+        simplices containing the sensor are then re-built from the
+        cliques in its neighbourhood.
+
+        The k-d tree used to find neighbours is re-built lazily once
+        a significant fraction of the sensors have moved.
+
+        This is called automatically for any sensors that have moved
+        when the structure is next accessed using :meth:`overhearing`.
+
+        :param s: the sensor'''
+        pg = self._playground
+        i = self._indices[s.id()]
+        self._P[i] = pg.sensorPositions()[pg.sensorIndex(s)]
+        if self._tree is not None:
+            self._moved.add(i)
+            if len(self._moved) * 8 > len(self._sensors):
+                self._tree = None
+
+        # find the sensor's new neighbours
+        ns = self._neighboursOf(i)
+
+        # if the neighbourhood is unchanged, so are the simplices
+        if ns == set(self._g[i]):
+            return
+
+        # remove all the edges incident on the sensor, which also
+        # removes all the higher simplices of which they're part
+        c = self.overhearing()
+        id = self._ids[i]
+        for j in list(self._g[i]):
+            c.deleteSimplexWithBasis([id, self._ids[j]])
+            self._g.remove_edge(i, j)
+
+        # re-attach the sensor to its new neighbours
+        self._attachSensor(i, ns)
+
+
+    def addSensor(self, s: Sensor):
+        '''Add a sensor to the overhearing structure.
+
+        Rather than rebuilding the whole complex, this finds the
+        sensors that overlap with the new sensor and adds only the
+        simplices that contain it. Sensors without the
+        :class:`TargetCount` modality are ignored.
+
+        :param s: the sensor'''
+        if not isinstance(s, TargetCount) or s.id() in self._indices:
+            return
+
+        # extend the snapshot with the new sensor, which isn't in
+        # the k-d tree and so is treated as having moved
+        i = len(self._sensors)
+        self._sensors.append(s)
+        self._ids.append(s.id())
+        self._indices[s.id()] = i
+        pg = self._playground
+        j = pg.sensorIndex(s)
+        self._P = numpy.vstack((self._P, pg.sensorPositions()[j:j + 1].astype(self._P.dtype)))
+        self._R = numpy.append(self._R, pg.sensorRadii()[j]).astype(self._R.dtype)
+        self._counts = numpy.append(self._counts, 0).astype(self._counts.dtype)
+        self._countsChanged = True
+        if self._tree is not None:
+            self._moved.add(i)
+            if len(self._moved) * 8 > len(self._sensors):
+                self._tree = None
+
+        # add the sensor as a 0-simplex and attach it to its neighbours
+        self.overhearing().addSimplex(id=s.id())
+        self._g.add_node(i)
+        self._attachSensor(i, self._neighboursOf(i))
+
+
+    def _neighboursOf(self, i: int) -> Set[int]:
+        '''Return the sensors whose fields overlap with the given sensor.
+
+        :param i: the sensor index
+        :returns: the indices of the overlapping sensors'''
+        js = numpy.fromiter(self._candidatesNear(i), dtype=int)
+        return set(js[self._overlaps(i, js)].tolist())
+
+
+    def _attachSensor(self, i: int, ns: Set[int]):
+        '''Add the edges between a sensor and its neighbours, and all
+        the higher simplices containing them.
+
+        Every clique amongst the sensor's neighbours forms a
+        simplex with the sensor, so we only need to enumerate the
+        cliques in its neighbourhood rather than in the whole graph.
+
+        :param i: the sensor index
+        :param ns: the indices of the sensor's neighbours'''
+        c = self.overhearing()
+        id = self._ids[i]
+        self._g.add_edges_from((i, j) for j in ns)
+        bases = set()
+        for clique in networkx.find_cliques(self._g.subgraph(ns)):
+            clique.sort()
+            for k in range(1, len(clique) + 1):
+                bases.update(combinations(clique, k))
+        for pb in sorted(bases, key=len):
+            c.addSimplexWithBasis([id] + [self._ids[j] for j in pb])
+
+
     def overhearing(self) -> SimplicialComplex:
-        '''Return the overhearing complex.
+        '''Return the overhearing complex, first updating it for
+        any sensors that have moved.
 
         :returns: the complex'''
         if self._c is None:
             self.rebuild()
+        else:
+            self._updateMovedSensors()
         return self._c
 
 
     def metric(self) -> SimplicialFunction[int]:
-        '''Return the metric function.
+        '''Return the metric function. Any counts set since the
+        metric was last accessed are written into it first.
 
         :returns: the function'''
+        if self._countsChanged:
+            self._pushCounts()
         return self._f
 
 
     def rebuild(self):
-        '''Rebuild the overhearing structure. Needed if the underlying
-        playground has changed.'''
+        '''Rebuild the overhearing structure. Needed if sensors have
+        been added to or removed from the underlying playground: sensors
+        that move are tracked automatically.'''
         self._c = self._build()
 
 
+    # ---------- Counts ----------
+
+    # Counts are held in an array indexed in the same way as the sensors,
+    # and are only written into the metric function (which is comparatively
+    # expensive) when it's next needed.
+
+    def _pushCounts(self):
+        '''Write the counts into the metric function.'''
+        sf = self._f
+        for (id, c) in zip(self._ids, self._counts.tolist()):
+            sf[id] = c
+        self._countsChanged = False
+
+
+    def clearCounts(self):
+        '''Set the counts observed at all the sensors to zero.'''
+        self._counts.fill(0)
+        self._countsChanged = True
+
+
     def setCounts(self, cs: Dict[Sensor, int]):
         '''Set the counts observed at all the sensors. If a sensor
         appears more than once in the iteration, the last value is the
@@ -175,9 +435,10 @@ class EulerEstimator:
         '''
 
         # set the observed counts
-        sf = self.metric()
+        indices = self._indices
         for s in cs:
-            sf[s.id()] = cs[s]
+            self._counts[indices[s.id()]] = cs[s]
+        self._countsChanged = True
 
 
     def estimateFromCounts(self, cs: Dict[Sensor, int]) -> int:
@@ -190,6 +451,7 @@ class EulerEstimator:
         :returns: the estimated target count'''
 
         # set the counts
+        self.clearCounts()
         self.setCounts(cs)
 
         # integrate the Euler characteristics
@@ -199,11 +461,131 @@ class EulerEstimator:
         return count
 
 
+    def _gridCandidates(self, ps: numpy.ndarray, h: float, qs: numpy.ndarray) -> Tuple[numpy.ndarray, numpy.ndarray]:
+        '''Find the candidate sensor/target pairs using a uniform grid.
+
+        The sensors are bucketed into cells of side h, and each target
+        is paired with the sensors in its own and all adjacent cells.
+        If no sensor has a radius larger than h this includes every
+        sensor that can detect the target.
+
+        The buckets are held implicitly by sorting the sensors by
+        the linear index of their cells, so that the sensors in any
+        cell can be found by a binary search.
+
+        :param ps: the sensor positions, shape (K, d)
+        :param h: the cell size
+        :param qs: the target positions, shape (N, d)
+        :returns: a pair of arrays of sensor and target indices'''
+        d = qs.shape[1]
+
+        # compute the cells, discarding targets more than one cell
+        # outside the sensors' cells since no sensor can reach them
+        pcs = numpy.floor(ps / h)
+        qcs = numpy.floor(qs / h)
+        near = ((qcs >= pcs.min(axis=0) - 1) & (qcs <= pcs.max(axis=0) + 1)).all(axis=1)
+        tidxs = numpy.nonzero(near)[0]
+        pcs = pcs.astype(numpy.int64)
+        qcs = qcs[near].astype(numpy.int64)
+
+        # offset the cells so the neighbours of every target's cell
+        # have non-negative coordinates
+        lo = pcs.min(axis=0) - 2
+        pcs -= lo
+        qcs -= lo
+        dims = pcs.max(axis=0) + 3
+
+        # sort the sensors by cell
+        pks = numpy.ravel_multi_index(pcs.T, dims)
+        order = numpy.argsort(pks, kind='stable')
+        pks = pks[order]
+
+        # for each neighbouring cell, find the run of sensors in
+        # that cell for each target
+        sis = []
+        tis = []
+        for o in product([-1, 0, 1], repeat=d):
+            tks = numpy.ravel_multi_index((qcs + o).T, dims)
+            starts = numpy.searchsorted(pks, tks, side='left')
+            lens = numpy.searchsorted(pks, tks, side='right') - starts
+            n = lens.sum()
+            if n > 0:
+                ends = numpy.cumsum(lens)
+                runs = numpy.arange(n) - numpy.repeat(ends - lens, lens)
+                sis.append(order[numpy.repeat(starts, lens) + runs])
+                tis.append(numpy.repeat(tidxs, lens))
+        if len(sis) == 0:
+            return (numpy.empty(0, dtype=int), numpy.empty(0, dtype=int))
+        return (numpy.concatenate(sis), numpy.concatenate(tis))
+
+
+    def _countTargets(self, ps: numpy.ndarray, rs: numpy.ndarray, qs: numpy.ndarray,
+                      pnorms2: numpy.ndarray = None) -> numpy.ndarray:
+        '''Count the targets detected by each sensor.
+
+        For large numbers of sensors the candidate sensors for each
+        target are found first, and only these pairs are then tested
+        against the sensors' actual radii. If the sensors' radii are
+        all similar the candidates are found using a uniform grid
+        with cells the size of the largest radius; otherwise they're
+        found using a k-d tree, as the sensors within the largest radius
+        of each target. Smaller numbers of sensors are tested against
+        all the targets using :func:`countAll`.
+
+        Sensors without positions or radii (which have NaNs in the
+        playground's sensor arrays) are left out of the search, and
+        count no targets.
+
+        :param ps: the sensor positions, shape (K, d)
+        :param rs: the sensor radii, shape (K,)
+        :param qs: the target positions, shape (N, d)
+        :param pnorms2: (optional) the squared norms of the sensor positions, shape (K,)
+        :returns: a (K,) array of counts'''
+        K = len(ps)
+        N = len(qs)
+
+        # count only for the sensors that can detect anything
+        finite = numpy.isfinite(ps).all(axis=1) & numpy.isfinite(rs)
+        if not finite.all():
+            cs = numpy.zeros(K, dtype=int)
+            cs[finite] = self._countTargets(ps[finite], rs[finite], qs,
+                                            None if pnorms2 is None else pnorms2[finite])
+            return cs
+
+        if K >= self.KDTREE_THRESHOLD and N > 0:
+            # sensors with zero radius detect nothing
+            rmax = rs.max()
+            if rmax <= 0:
+                return numpy.zeros(K, dtype=int)
+
+            # find the candidate sensor/target pairs, using the grid
+            # only if its cells can be indexed
+            ncells = numpy.prod((ps.max(axis=0) - ps.min(axis=0)) / rmax + 5)
+            if rmax <= self.GRID_RADIUS_RATIO * rs.min() and ncells < 2 ** 62:
+                (si, ti) = self._gridCandidates(ps, rmax, qs)
+            else:
+                cands = cKDTree(ps).query_ball_point(qs, rmax)
+                lens = numpy.fromiter(map(len, cands), dtype=int, count=N)
+                si = numpy.fromiter(chain.from_iterable(cands), dtype=int, count=lens.sum())
+                ti = numpy.repeat(numpy.arange(N), lens)
+
+            # refine and count the pairs actually in range
+            diff = ps[si] - qs[ti]
+            d2 = numpy.einsum('ij,ij->i', diff, diff)
+            r = rs[si]
+            return numpy.bincount(si[d2 < r * r], minlength=K)
+        else:
+            return countAll(ps, rs * rs, qs, pnorms2)
+
+
     def estimateFromTargets(self, ts: Iterable[Position]) -> int:
         '''Estimate the count of a collection of targets.
 
         The estimator computes the counts at each sensor from
-        the target positions.
+        the target positions, testing all the sensors against all
+        the targets at once. The targets can be given as an (N, d)
+        array, which is used directly if it's already of the same
+        type as the playground's sensor arrays.
 
         One simple error measure is the fraction by which the estimate
         differs from the (known) actual number of targets.
@@ -211,10 +593,26 @@ class EulerEstimator:
         :param ts: the targets
         :returns: the estimated target count'''
 
-        # compute the counts at each sensor
-        cs = {}
-        for s in self._playground.allSensorsWithModality(TargetCount):
-            cs[s] = cast(TargetCount, s).counts(ts)
+        # gather the sensors' current positions and radii
+        pg = self._playground
+        ss = pg.allSensorsWithModality(TargetCount)
+        rows = [pg.sensorIndex(s) for s in ss]
+        ps = pg.sensorPositions()[rows]
+        rs = pg.sensorRadii()[rows]
+        pnorms2 = pg.sensorSquaredNorms()[rows]
+
+        # convert the targets to an array matching the sensors', which
+        # doesn't copy targets that are already given in this form
+        if not isinstance(ts, (numpy.ndarray, list, tuple)):
+            ts = list(ts)
+        qs = numpy.ascontiguousarray(ts, dtype=ps.dtype)
+        if qs.ndim < 2:
+            qs = qs.reshape((-1, ps.shape[1]))
+
+        # compute the counts at all the sensors at once, which
+        # ignores any sensors that aren't positioned
+        counts = self._countTargets(ps, rs, qs, pnorms2)
+        cs = {s: int(c) for (s, c) in zip(ss, counts)}
 
         # compute the estimate
         return self.estimateFromCounts(cs)
@@ -0,0 +1,509 @@
+# Compiled kernels for bulk sensing operations
+#
+# Copyright (C) 2024 Simon Dobson
+#
+# This file is part of sensor-playground, an experimental framework for
+# target counting and higher-order sensor data analytics
+#
+# This is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This software is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this software. If not, see <http://www.gnu.org/licenses/gpl.html>.
+
+import os
+import numpy
+from concurrent.futures import ThreadPoolExecutor
+
+# Numba is optional: if it's not available we fall back to vectorised
+# numpy versions of the kernels, which give the same answers but run
+# single-threaded and materialise their intermediate arrays.
+try:
+    from numba import njit, prange
+    HAVE_NUMBA = True
+except ImportError:
+    HAVE_NUMBA = False
+
+# The Numba kernels are compiled without fastmath. The playground's
+# sensor arrays hold NaN rows for sensors without positions or radii,
+# and fastmath lets the compiler assume there are no NaNs, which makes
+# comparisons against them come out True: a NaN sensor would then
+# detect every target and overlap every other sensor. Without it the
+# kernels treat NaNs in the same way as the numpy versions.
+
+# Ahead-of-time compiled versions of some kernels may also be available
+# if they've been built by build_kernels.py. These are serial, but avoid
+# the cost of JIT compilation, so they're used in preference to the
+# JIT-compiled kernels for inputs smaller than AOT_ELEMENTS, and for all
+# inputs if Numba isn't available.
+try:
+    from sensorplayground import _kernels
+except ImportError:
+    _kernels = None
+
+AOT_ELEMENTS = 1 << 20
+
+
+# Vectorised numpy kernels build intermediate arrays whose size is the
+# product of their inputs' sizes. To bound peak memory on large inputs
+# they work in blocks of rows containing at most this many elements.
+CHUNK_ELEMENTS = 1 << 22
+
+
+def _chunkRows(n: int, rowElements: int) -> int:
+    '''Return the number of rows to process in each block.
+
+    :param n: the total number of rows
+    :param rowElements: the number of intermediate elements per row
+    :returns: the number of rows per block'''
+    return max(1, min(n, CHUNK_ELEMENTS // max(1, rowElements)))
+
+
+# numpy releases the GIL inside its matrix products and comparisons,
+# so the numpy kernels can split large sets of targets across threads.
+# Each thread handles at least this many targets.
+THREAD_TARGETS = 1 << 14
+
+
+def _aotKernel(name: str, work: int, *arrays: numpy.ndarray):
+    '''Return the ahead-of-time compiled version of a kernel, if
+    there is one that matches the types of the arguments and is
+    suitable for the amount of work.
+
+    :param name: the kernel name
+    :param work: the number of elements the kernel will process
+    :param arrays: the floating-point arguments
+    :returns: the kernel, or None'''
+    if _kernels is None or (HAVE_NUMBA and work >= AOT_ELEMENTS):
+        return None
+    t = arrays[0].dtype
+    if any(a.dtype != t for a in arrays):
+        return None
+    if t == numpy.float32:
+        return getattr(_kernels, name + '_f4', None)
+    elif t == numpy.float64:
+        return getattr(_kernels, name + '_f8', None)
+    else:
+        return None
+
+
+# ---------- Sensor/target detection ----------
+
+def _detectAllNumpy(ps: numpy.ndarray, r2s: numpy.ndarray, qs: numpy.ndarray,
+                    pnorms2: numpy.ndarray = None) -> numpy.ndarray:
+    '''Vectorised detection of all targets by all sensors.
+
+    This uses the identity |p - q|^2 = p.p + q.q - 2 p.q, so that the
+    bulk of the work is a single matrix product of the sensor and target
+    positions and the intermediate arrays are only (K, N).
+
+    The identity subtracts large, nearly-equal terms for points far
+    from the origin, which loses all the precision of single-precision
+    positions, so the calculation is always done in double precision.
+    The squared norms of the sensor positions are only re-used if they
+    are also double-precision.
+
+    :param ps: the sensor positions, shape (K, d)
+    :param r2s: the squared sensor radii, shape (K,)
+    :param qs: the target positions, shape (N, d)
+    :param pnorms2: (optional) the squared norms of the sensor positions, shape (K,)
+    :returns: a (K, N) boolean detection matrix'''
+    K = ps.shape[0]
+    N = qs.shape[0]
+    ps = ps.astype(numpy.float64, copy=False)
+    qs = qs.astype(numpy.float64, copy=False)
+    if pnorms2 is None or pnorms2.dtype != numpy.float64:
+        pnorms2 = numpy.einsum('ij,ij->i', ps, ps)
+    qnorms2 = numpy.einsum('ij,ij->i', qs, qs)
+    ds = numpy.empty((K, N), dtype=bool)
+    step = _chunkRows(K, N)
+    for b in range(0, K, step):
+        e = min(b + step, K)
+        d2 = pnorms2[b:e, numpy.newaxis] + qnorms2[numpy.newaxis, :] - 2 * (ps[b:e] @ qs.T)
+        ds[b:e] = d2 < r2s[b:e, numpy.newaxis]
+    return ds
+
+
+if HAVE_NUMBA:
+    @njit(parallel=True, cache=True, nogil=True)
+    def _detectAllNumba(ps, r2s, qs):
+        K, d = ps.shape
+        N = qs.shape[0]
+        ds = numpy.empty((K, N), dtype=numpy.bool_)
+        for i in prange(K):
+            for j in range(N):
+                d2 = 0.0
+                for k in range(d):
+                    dx = ps[i, k] - qs[j, k]
+                    d2 += dx * dx
+                ds[i, j] = d2 < r2s[i]
+        return ds
+
+
+    # Specialised kernels for the common two- and three-dimensional
+    # cases, with the loop over dimensions unrolled so that the
+    # coordinates of each sensor stay in registers
+
+    @njit(parallel=True, cache=True, nogil=True)
+    def _detectAll2Numba(ps, r2s, qs):
+        K = ps.shape[0]
+        N = qs.shape[0]
+        ds = numpy.empty((K, N), dtype=numpy.bool_)
+        for i in prange(K):
+            (px, py, r2) = (ps[i, 0], ps[i, 1], r2s[i])
+            for j in range(N):
+                dx = px - qs[j, 0]
+                dy = py - qs[j, 1]
+                ds[i, j] = dx * dx + dy * dy < r2
+        return ds
+
+
+    @njit(parallel=True, cache=True, nogil=True)
+    def _detectAll3Numba(ps, r2s, qs):
+        K = ps.shape[0]
+        N = qs.shape[0]
+        ds = numpy.empty((K, N), dtype=numpy.bool_)
+        for i in prange(K):
+            (px, py, pz, r2) = (ps[i, 0], ps[i, 1], ps[i, 2], r2s[i])
+            for j in range(N):
+                dx = px - qs[j, 0]
+                dy = py - qs[j, 1]
+                dz = pz - qs[j, 2]
+                ds[i, j] = dx * dx + dy * dy + dz * dz < r2
+        return ds
+
+
+def detectAll(ps: numpy.ndarray, r2s: numpy.ndarray, qs: numpy.ndarray,
+              pnorms2: numpy.ndarray = None) -> numpy.ndarray:
+    '''Compute which sensors can detect which targets.
+
+    A sensor detects a target if the squared distance between them
+    is strictly less than the sensor's squared radius. When Numba is
+    available this runs in parallel across sensors without building
+    any intermediate arrays, using kernels specialised for two and
+    three dimensions where possible; otherwise it uses a vectorised numpy
+    expression, which can re-use the squared norms of the sensor
+    positions if the caller has them to hand.
+
+    :param ps: the sensor positions, shape (K, d)
+    :param r2s: the squared sensor radii, shape (K,)
+    :param qs: the target positions, shape (N, d)
+    :param pnorms2: (optional) the squared norms of the sensor positions, shape (K,)
+    :returns: a (K, N) boolean detection matrix'''
+    (K, d) = ps.shape
+    k = _aotKernel(f'detectAll{d}', K * qs.shape[0], ps, r2s, qs)
+    if k is not None:
+        return k(ps, r2s, qs)
+    if HAVE_NUMBA:
+        if d == 2:
+            return _detectAll2Numba(ps, r2s, qs)
+        elif d == 3:
+            return _detectAll3Numba(ps, r2s, qs)
+        else:
+            return _detectAllNumba(ps, r2s, qs)
+    else:
+        return _detectAllNumpy(ps, r2s, qs, pnorms2)
+
+
+def _countAllNumpy(ps: numpy.ndarray, r2s: numpy.ndarray, qs: numpy.ndarray,
+                   pnorms2: numpy.ndarray = None) -> numpy.ndarray:
+    '''Vectorised count of the targets detected by each sensor.
+
+    :param ps: the sensor positions, shape (K, d)
+    :param r2s: the squared sensor radii, shape (K,)
+    :param qs: the target positions, shape (N, d)
+    :param pnorms2: (optional) the squared norms of the sensor positions, shape (K,)
+    :returns: a (K,) array of counts'''
+    ps = ps.astype(numpy.float64, copy=False)
+    if pnorms2 is None or pnorms2.dtype != numpy.float64:
+        pnorms2 = numpy.einsum('ij,ij->i', ps, ps)
+    N = qs.shape[0]
+    nthreads = min(os.cpu_count() or 1, N // THREAD_TARGETS)
+    if nthreads <= 1:
+        return _detectAllNumpy(ps, r2s, qs, pnorms2).sum(axis=1)
+
+    # count the targets in each block in its own thread, and
+    # add up the counts
+    bs = numpy.linspace(0, N, nthreads + 1, dtype=int)
+    with ThreadPoolExecutor(max_workers=nthreads) as pool:
+        cs = pool.map(lambda b, e: _detectAllNumpy(ps, r2s, qs[b:e], pnorms2).sum(axis=1),
+                      bs[:-1], bs[1:])
+        return sum(cs)
+
+
+if HAVE_NUMBA:
+    @njit(parallel=True, cache=True, nogil=True)
+    def _countAllNumba(ps, r2s, qs):
+        K, d = ps.shape
+        N = qs.shape[0]
+        cs = numpy.zeros(K, dtype=numpy.int64)
+        for i in prange(K):
+            c = 0
+            for j in range(N):
+                d2 = 0.0
+                for k in range(d):
+                    dx = ps[i, k] - qs[j, k]
+                    d2 += dx * dx
+                if d2 < r2s[i]:
+                    c += 1
+            cs[i] = c
+        return cs
+
+
+    @njit(parallel=True, cache=True, nogil=True)
+    def _countAll2Numba(ps, r2s, qs):
+        K = ps.shape[0]
+        N = qs.shape[0]
+        cs = numpy.zeros(K, dtype=numpy.int64)
+        for i in prange(K):
+            (px, py, r2) = (ps[i, 0], ps[i, 1], r2s[i])
+            c = 0
+            for j in range(N):
+                dx = px - qs[j, 0]
+                dy = py - qs[j, 1]
+                if dx * dx + dy * dy < r2:
+                    c += 1
+            cs[i] = c
+        return cs
+
+
+    @njit(parallel=True, cache=True, nogil=True)
+    def _countAll3Numba(ps, r2s, qs):
+        K = ps.shape[0]
+        N = qs.shape[0]
+        cs = numpy.zeros(K, dtype=numpy.int64)
+        for i in prange(K):
+            (px, py, pz, r2) = (ps[i, 0], ps[i, 1], ps[i, 2], r2s[i])
+            c = 0
+            for j in range(N):
+                dx = px - qs[j, 0]
+                dy = py - qs[j, 1]
+                dz = pz - qs[j, 2]
+                if dx * dx + dy * dy + dz * dz < r2:
+                    c += 1
+            cs[i] = c
+        return cs
+
+
+def countAll(ps: numpy.ndarray, r2s: numpy.ndarray, qs: numpy.ndarray,
+             pnorms2: numpy.ndarray = None) -> numpy.ndarray:
+    '''Count the targets that each sensor can detect.
+
+    This gives the same answers as summing the rows of the matrix
+    returned by :func:`detectAll`. When Numba is available the
+    distance, comparison, and count are fused into a single pass
+    and the detection matrix is never built. Otherwise large sets
+    of targets are split into blocks that are counted in parallel
+    threads.
+
+    :param ps: the sensor positions, shape (K, d)
+    :param r2s: the squared sensor radii, shape (K,)
+    :param qs: the target positions, shape (N, d)
+    :param pnorms2: (optional) the squared norms of the sensor positions, shape (K,)
+    :returns: a (K,) array of counts'''
+    (K, d) = ps.shape
+    k = _aotKernel(f'countAll{d}', K * qs.shape[0], ps, r2s, qs)
+    if k is not None:
+        return k(ps, r2s, qs)
+    if HAVE_NUMBA:
+        if d == 2:
+            return _countAll2Numba(ps, r2s, qs)
+        elif d == 3:
+            return _countAll3Numba(ps, r2s, qs)
+        else:
+            return _countAllNumba(ps, r2s, qs)
+    else:
+        return _countAllNumpy(ps, r2s, qs, pnorms2)
+
+
+# ---------- Single-sensor detection ----------
+
+def _withinRadiusNumpy(p: numpy.ndarray, r2: float, qs: numpy.ndarray) -> numpy.ndarray:
+    '''Vectorised test of which targets lie within a sensor's radius.
+
+    :param p: the sensor position, shape (d,)
+    :param r2: the squared sensor radius
+    :param qs: the target positions, shape (N, d)
+    :returns: an (N,) boolean mask'''
+    diff = qs - p
+    return numpy.einsum('ij,ij->i', diff, diff) < r2
+
+
+if HAVE_NUMBA:
+    @njit(cache=True, nogil=True)
+    def _withinRadiusNumba(p, r2, qs):
+        N, d = qs.shape
+        ms = numpy.empty(N, dtype=numpy.bool_)
+        for j in range(N):
+            d2 = 0.0
+            for k in range(d):
+                dx = qs[j, k] - p[k]
+                d2 += dx * dx
+            ms[j] = d2 < r2
+        return ms
+
+
+def withinRadius(p: numpy.ndarray, r2: float, qs: numpy.ndarray) -> numpy.ndarray:
+    '''Compute which targets lie strictly within a single sensor's
+    detection radius.
+
+    This is the per-event test made when a sensor samples the targets
+    around it. The numbers of targets involved are usually small,
+    so the Numba version is serial, and avoids the intermediate
+    arrays of the numpy version.
+
+    :param p: the sensor position, shape (d,)
+    :param r2: the squared sensor radius
+    :param qs: the target positions, shape (N, d)
+    :returns: an (N,) boolean mask'''
+    if HAVE_NUMBA:
+        return _withinRadiusNumba(p, r2, qs)
+    else:
+        return _withinRadiusNumpy(p, r2, qs)
+
+
+_warmedUp = False
+
+
+def warmUp():
+    '''Compile the kernels used on every event, so that the cost of
+    JIT compilation isn't paid by the first event of a simulation.
+    This only does anything the first time it's called, and not at all
+    if Numba isn't available.'''
+    global _warmedUp
+    if HAVE_NUMBA and not _warmedUp:
+        _withinRadiusNumba(numpy.zeros(2), 1.0, numpy.zeros((1, 2)))
+        _warmedUp = True
+
+
+# ---------- Sensor overlaps ----------
+
+def _overlapMatrixNumpy(ps: numpy.ndarray, rs: numpy.ndarray) -> numpy.ndarray:
+    '''Vectorised test for overlaps between all pairs of sensors.
+
+    :param ps: the sensor positions, shape (K, d)
+    :param rs: the sensor radii, shape (K,)
+    :returns: a (K, K) boolean overlap matrix'''
+    K, d = ps.shape
+    m = numpy.empty((K, K), dtype=bool)
+    step = _chunkRows(K, K * d)
+    for b in range(0, K, step):
+        e = min(b + step, K)
+        diff = ps[b:e, numpy.newaxis, :] - ps[numpy.newaxis, :, :]
+        d2 = numpy.einsum('ijk,ijk->ij', diff, diff)
+        rsum = rs[b:e, numpy.newaxis] + rs[numpy.newaxis, :]
+        m[b:e] = d2 < rsum * rsum
+    numpy.fill_diagonal(m, False)
+    return m
+
+
+if HAVE_NUMBA:
+    @njit(parallel=True, cache=True, nogil=True)
+    def _overlapMatrixNumba(ps, rs):
+        K, d = ps.shape
+        m = numpy.zeros((K, K), dtype=numpy.bool_)
+        for i in prange(K):
+            for j in range(i + 1, K):
+                d2 = 0.0
+                for k in range(d):
+                    dx = ps[i, k] - ps[j, k]
+                    d2 += dx * dx
+                rsum = rs[i] + rs[j]
+                if d2 < rsum * rsum:
+                    m[i, j] = True
+                    m[j, i] = True
+        return m
+
+
+def overlapMatrix(ps: numpy.ndarray, rs: numpy.ndarray) -> numpy.ndarray:
+    '''Compute which pairs of sensors have overlapping sensor fields.
+
+    Two sensors overlap if the distance between them is strictly
+    less than the sum of their radii. A sensor isn't considered to
+    overlap with itself. When Numba is available the matrix is
+    computed in parallel and only the upper triangle is tested;
+    otherwise it uses a vectorised numpy expression.
+
+    :param ps: the sensor positions, shape (K, d)
+    :param rs: the sensor radii, shape (K,)
+    :returns: a symmetric (K, K) boolean overlap matrix'''
+    K = ps.shape[0]
+    k = _aotKernel('overlapMatrix', K * K, ps, rs)
+    if k is not None:
+        return k(ps, rs)
+    if HAVE_NUMBA:
+        return _overlapMatrixNumba(ps, rs)
+    else:
+        return _overlapMatrixNumpy(ps, rs)
+
+
+# ---------- Fused motion and detection ----------
+
+def _advanceAndDetectNumpy(t: float,
+                           p0s: numpy.ndarray, deltas: numpy.ndarray,
+                           t0s: numpy.ndarray, invDurs: numpy.ndarray,
+                           ps: numpy.ndarray, r2s: numpy.ndarray) -> numpy.ndarray:
+    '''Vectorised detection of targets moving along linear trajectories.
+
+    :param t: the simulation time
+    :param p0s: the trajectory start points, shape (N, d)
+    :param deltas: the trajectory displacements, shape (N, d)
+    :param t0s: the trajectory start times, shape (N,)
+    :param invDurs: the reciprocals of the trajectory durations, shape (N,)
+    :param ps: the sensor positions, shape (K, d)
+    :param r2s: the squared sensor radii, shape (K,)
+    :returns: a (K, N) boolean detection matrix'''
+    alphas = numpy.clip((t - t0s) * invDurs, 0.0, 1.0)
+    qs = p0s + deltas * alphas[:, numpy.newaxis]
+    return _detectAllNumpy(ps, r2s, qs)
+
+
+if HAVE_NUMBA:
+    @njit(parallel=True, cache=True, nogil=True)
+    def _advanceAndDetectNumba(t, p0s, deltas, t0s, invDurs, ps, r2s):
+        K, d = ps.shape
+        N = p0s.shape[0]
+        ds = numpy.empty((K, N), dtype=numpy.bool_)
+        for i in prange(K):
+            for j in range(N):
+                a = min(max((t - t0s[j]) * invDurs[j], 0.0), 1.0)
+                d2 = 0.0
+                for k in range(d):
+                    dx = p0s[j, k] + deltas[j, k] * a - ps[i, k]
+                    d2 += dx * dx
+                ds[i, j] = d2 < r2s[i]
+        return ds
+
+
+def advanceAndDetect(t: float,
+                     p0s: numpy.ndarray, deltas: numpy.ndarray,
+                     t0s: numpy.ndarray, invDurs: numpy.ndarray,
+                     ps: numpy.ndarray, r2s: numpy.ndarray) -> numpy.ndarray:
+    '''Compute which sensors can detect which targets at a given time,
+    where the targets are following linear trajectories.
+
+    This fuses interpolating the targets' positions with the detection
+    test. When Numba is available the interpolated positions are never
+    stored; otherwise they are computed as an intermediate array.
+    Targets outside their motion interval are taken to be at the
+    nearer endpoint of their trajectory.
+
+    :param t: the simulation time
+    :param p0s: the trajectory start points, shape (N, d)
+    :param deltas: the trajectory displacements, shape (N, d)
+    :param t0s: the trajectory start times, shape (N,)
+    :param invDurs: the reciprocals of the trajectory durations, shape (N,)
+    :param ps: the sensor positions, shape (K, d)
+    :param r2s: the squared sensor radii, shape (K,)
+    :returns: a (K, N) boolean detection matrix'''
+    if HAVE_NUMBA:
+        return _advanceAndDetectNumba(t, p0s, deltas, t0s, invDurs, ps, r2s)
+    else:
+        return _advanceAndDetectNumpy(t, p0s, deltas, t0s, invDurs, ps, r2s)
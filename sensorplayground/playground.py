@@ -18,11 +18,15 @@
 # You should have received a copy of the GNU General Public License
 # along with this software. If not, see <http://www.gnu.org/licenses/gpl.html>.
 
+import numpy
 from heapq import heappush, heappop
+from itertools import chain
 from rtree import index
-from typing import Callable, Iterable, Dict, List, Tuple, Set, Any, Union, Type
+from scipy.spatial import cKDTree
+from typing import Callable, Iterable, Dict, List, Tuple, Set, Any, Union, Type, Optional
 from simplicial import Isomorphism
-from sensorplayground import Agent, Sensor, Position, BoundingBox
+from sensorplayground import Agent, Sensor, SimpleTargetCountSensor, Position, BoundingBox, vectorPosition
+from sensorplayground.kernels import warmUp
 
 
 # Events
@@ -37,13 +41,15 @@ class SensorPlayground:
     Simulation times are a sequence of integers.
 
     :param d: (optional) the dimensions of the playground (2 or 3) (defaults to 2)
+    :param dtype: (optional) the floating-point type of the sensor arrays (defaults to float32)
     '''
 
 
     MAXIMUM_TIME = 10000.0   #: Default maximum simulation time.
+    KDTREE_THRESHOLD = 50    #: Number of agents above which proximity searches use a k-d tree.
 
 
-    def __init__(self, d: int = 2):
+    def __init__(self, d: int = 2, dtype: numpy.dtype = numpy.float32):
         # state
         self._agents: Set[Agent] = set()
         self._agentIds: Dict[Any, Agent] = dict()
@@ -57,11 +63,26 @@ class SensorPlayground:
         self._indices: Isomorphism[int, Union[Sensor, Agent]] = Isomorphism()
         self._boundingBoxes: Dict[int, BoundingBox] = dict()
 
+        # proximity index
+        self._invalidateProximityIndex()
+
+        # sensor arrays
+        self._dimension: int = d
+        self._dtype: numpy.dtype = dtype
+        self._sensors: List[Sensor] = []
+        self._indexOf: Dict[Sensor, int] = dict()
+        self._pendingSensors: List[Sensor] = []
+        self._allocateSensorArrays(self.SENSOR_ARRAYS_CAPACITY)
+        self._dirty: bool = False
+        self._invalidateSensorIndex()
+
         # simulation
         self._simulationTime: float = 0.0
         self._maximumSimulationTime: float = SensorPlayground.MAXIMUM_TIME
         self._events: List[Event] = []
+        self._dueEvents: List[Event] = []
         self._eventId: int = 0
+        warmUp()
 
 
     # ---------- Agent management ----------
@@ -72,6 +93,9 @@ class SensorPlayground:
         :param a: the agent'''
         self._agents.add(a)
         self._agentIds[a.id()] = a
+        self._invalidateProximityIndex()
+        for s in a.sensors():
+            self.sensorAdded(s)
 
         # set up the agent within the playground
         a.setUp(self)
@@ -89,6 +113,15 @@ class SensorPlayground:
         # remove the agent
         self._agents.remove(a)
         del self._agentIds[id]
+        self._invalidateProximityIndex()
+        self._invalidateSensorArrays()
+
+        # remove any events for the agent or its sensors
+        sas = set(a.sensors())
+        sas.add(a)
+        for ev in chain(self._events, self._dueEvents):
+            if ev[2] in sas:
+                self._markEventAsDeleted(ev)
 
 
     def getAgent(self, id: Any) -> Agent:
@@ -172,7 +205,7 @@ class SensorPlayground:
         :param bb: the bounding box:
         :returns: the list of edge co-ordinates'''
         (bl, tr) = bb.corners()
-        return list(bl) + list(tr)
+        return numpy.concatenate((bl, tr)).tolist()
 
 
     def _getAgent(self, i: int) -> Union[Sensor, Agent]:
@@ -194,6 +227,8 @@ class SensorPlayground:
         i = self._getIndex(a)
         self._boundingBoxes[i] = bb
         self._boxes.insert(i, self._rtreeBoundingBox(bb))
+        self._invalidateProximityIndex()
+        self._updateSensorPositions(a)
 
 
     def removeAgentBoundingBox(self, sa: Union[Sensor, Agent]):
@@ -205,6 +240,335 @@ class SensorPlayground:
             bb = self._boundingBoxes[i]
             self._boxes.delete(i, self._rtreeBoundingBox(bb))
             del self._boundingBoxes[i]
+        self._invalidateProximityIndex()
+        if isinstance(sa, Agent):
+            self._updateSensorPositions(sa)
+
+
+    # ---------- Proximity functions ----------
+
+    # Searches for agents near a point use a k-d tree over the positions
+    # of all the positioned agents. The index is rebuilt lazily the first
+    # time it's needed after any agent changes position, either by being
+    # explicitly re-positioned or by the simulation time advancing (which
+    # moves any mobile agents). For small numbers of agents it's faster
+    # to check all their positions directly than to build a tree.
+
+    def _invalidateProximityIndex(self):
+        '''Mark the proximity index as needing to be rebuilt.'''
+        self._proximityAgents: List[Agent] = None
+        self._proximityPositions: numpy.ndarray = None
+        self._proximityTree: cKDTree = None
+        self._sampledCounts: Dict[Sensor, int] = dict()
+
+
+    def _buildProximityIndex(self):
+        '''Build the proximity index if it's been invalidated.'''
+        if self._proximityAgents is None:
+            self._proximityAgents = [a for a in self._agents if a.isPositioned()]
+            if len(self._proximityAgents) > 0:
+                self._proximityPositions = numpy.asarray([a.position() for a in self._proximityAgents],
+                                                         dtype=numpy.float64)
+                if len(self._proximityAgents) >= self.KDTREE_THRESHOLD:
+                    self._proximityTree = cKDTree(self._proximityPositions)
+
+
+    def allAgentsWithinDistance(self, p: Position, r: float,
+                                cls: Type[Agent] = None) -> List[Agent]:
+        '''Return all the agents within a given distance of a point.
+
+        The search includes agents lying exactly at distance r, so callers
+        needing an open region should refine the results.
+
+        :param p: the point
+        :param r: the distance
+        :param cls: (optional) the class of agents returned (defaults to all)
+        :returns: the agents'''
+        self._buildProximityIndex()
+        if self._proximityTree is not None:
+            # use the k-d tree
+            idxs = self._proximityTree.query_ball_point(p, r)
+        elif self._proximityPositions is not None:
+            # check all the positions directly
+            diff = self._proximityPositions - vectorPosition(p)
+            idxs = numpy.nonzero(numpy.einsum('ij,ij->i', diff, diff) <= r * r)[0]
+        else:
+            # no positioned agents
+            idxs = []
+        agents = [self._proximityAgents[i] for i in idxs]
+
+        # filter-out agents not of the correct class
+        if cls is not None:
+            agents = [a for a in agents if isinstance(a, cls)]
+
+        return agents
+
+
+    def positionedAgents(self) -> Tuple[List[Agent], numpy.ndarray]:
+        '''Return all the agents that have positions, together with
+        their positions as an array whose rows correspond to the agents.
+
+        The array is shared with the proximity index and shouldn't be
+        modified.
+
+        :returns: a pair of the agents and an (N, d) array of their positions'''
+        self._buildProximityIndex()
+        if self._proximityPositions is None:
+            return ([], numpy.empty((0, self._dimension)))
+        return (self._proximityAgents, self._proximityPositions)
+
+
+    # ---------- Sensor arrays ----------
+
+    # The positions and radii of all the sensors in the playground are
+    # held as contiguous arrays (a "structure of arrays"), indexed by
+    # the position of each sensor in the list returned by :meth:`allSensors`.
+    # This lets operations over many sensors work on the arrays directly
+    # rather than gathering the sensors' attributes one by one.
+    #
+    # The arrays are views onto larger buffers, so that adding a sensor
+    # usually just fills the next free row when the arrays are next used,
+    # with the buffers doubling in size when they fill up. Re-positioning
+    # an agent updates its sensors' rows in place. The squared radii
+    # and the squared norms of the positions are kept alongside them.
+    # The arrays are rebuilt lazily when sensors or agents are removed,
+    # or when the simulation time advances (which moves any mobile
+    # agents). Sensors without a position or detection radius have NaNs
+    # in the corresponding rows.
+    #
+    # The arrays are single-precision by default, which is ample for
+    # comparing distances against radii and halves the memory traffic
+    # of bulk operations. Playgrounds needing more precision can ask
+    # for double-precision arrays instead.
+
+    SENSOR_ARRAYS_CAPACITY = 16   #: Initial number of rows allocated for sensor arrays.
+
+
+    def _invalidateSensorArrays(self):
+        '''Mark the sensor arrays as needing to be rebuilt.'''
+        self._dirty: bool = True
+        self._invalidateSensorIndex()
+
+
+    def _invalidateSensorIndex(self):
+        '''Mark the k-d tree over the sensors' positions as needing
+        to be rebuilt.'''
+        self._sensorTree: cKDTree = None
+        self._sensorTreeRows: numpy.ndarray = None
+
+
+    def _allocateSensorArrays(self, capacity: int):
+        '''Allocate new buffers for the sensor arrays, copying in
+        any existing rows.
+
+        :param capacity: the number of rows to allocate'''
+        n = len(self._sensors)
+        pb = numpy.full((capacity, self._dimension), numpy.nan, dtype=self._dtype)
+        rb = numpy.full(capacity, numpy.nan, dtype=self._dtype)
+        r2b = numpy.full(capacity, numpy.nan, dtype=self._dtype)
+        nb = numpy.full(capacity, numpy.nan, dtype=self._dtype)
+        if n > 0:
+            pb[:n] = self._positionsBuffer[:n]
+            rb[:n] = self._radiiBuffer[:n]
+            r2b[:n] = self._radii2Buffer[:n]
+            nb[:n] = self._norms2Buffer[:n]
+        self._positionsBuffer = pb
+        self._radiiBuffer = rb
+        self._radii2Buffer = r2b
+        self._norms2Buffer = nb
+        self._positions = pb[:n]
+        self._radii = rb[:n]
+        self._radii2 = r2b[:n]
+        self._norms2 = nb[:n]
+
+
+    def _appendSensor(self, s: Sensor):
+        '''Add a sensor to the next free row of the sensor arrays,
+        growing them if needed.
+
+        :param s: the sensor'''
+        n = len(self._sensors)
+        if n == len(self._radiiBuffer):
+            self._allocateSensorArrays(max(2 * n, self.SENSOR_ARRAYS_CAPACITY))
+        self._sensors.append(s)
+        self._indexOf[s] = n
+        a = s.agent()
+        if a is not None and a.isPositioned():
+            p = self._positionsBuffer[n]
+            p[:] = a.position()
+            self._norms2Buffer[n] = p @ p
+        if hasattr(s, 'detectionRadius'):
+            r = self._radiiBuffer[n] = s.detectionRadius()
+            self._radii2Buffer[n] = r * r
+        self._positions = self._positionsBuffer[:n + 1]
+        self._radii = self._radiiBuffer[:n + 1]
+        self._radii2 = self._radii2Buffer[:n + 1]
+        self._norms2 = self._norms2Buffer[:n + 1]
+        self._invalidateSensorIndex()
+
+
+    def _buildSensorArrays(self):
+        '''Build the sensor arrays if they've been invalidated, or
+        add any sensors added since they were last used.'''
+        if not self._dirty:
+            if len(self._pendingSensors) > 0:
+                for s in self._pendingSensors:
+                    if s not in self._indexOf:
+                        self._appendSensor(s)
+                self._pendingSensors = []
+        else:
+            ss = [s for a in self._agents for s in a.sensors()]
+            n = len(ss)
+            self._pendingSensors: List[Sensor] = []
+            self._sensors: List[Sensor] = []
+            self._allocateSensorArrays(max(n, self.SENSOR_ARRAYS_CAPACITY))
+            self._sensors = ss
+            self._indexOf: Dict[Sensor, int] = {s: i for (i, s) in enumerate(ss)}
+            self._positions = self._positionsBuffer[:n]
+            self._radii = self._radiiBuffer[:n]
+            self._radii2 = self._radii2Buffer[:n]
+            self._norms2 = self._norms2Buffer[:n]
+
+            # the sensors of each agent occupy consecutive rows, so we
+            # can retrieve each agent's position once and fill them all
+            i = 0
+            for a in self._agents:
+                k = len(a.sensors())
+                if k > 0 and a.isPositioned():
+                    self._positions[i:i + k] = a.position()
+                i += k
+            numpy.einsum('ij,ij->i', self._positions, self._positions, out=self._norms2)
+            for (i, s) in enumerate(self._sensors):
+                if hasattr(s, 'detectionRadius'):
+                    self._radii[i] = s.detectionRadius()
+            numpy.multiply(self._radii, self._radii, out=self._radii2)
+            self._dirty = False
+
+
+    def _updateSensorPositions(self, a: Agent):
+        '''Update the positions of all the sensors attached to an agent
+        in place in the sensor arrays.
+
+        :param a: the agent'''
+        if not self._dirty:
+            self._buildSensorArrays()
+            if a.isPositioned():
+                p = numpy.asarray(a.position(), dtype=self._dtype)
+                n2 = p @ p
+            else:
+                p = n2 = numpy.nan
+            for s in a.sensors():
+                if s in self._indexOf:
+                    i = self._indexOf[s]
+                    self._positions[i] = p
+                    self._norms2[i] = n2
+                    self._invalidateSensorIndex()
+                else:
+                    # not a sensor we know about
+                    self._invalidateSensorArrays()
+                    return
+
+
+    def _buildSensorIndex(self):
+        '''Build the k-d tree over the positions of those sensors
+        having a position and a detection radius, if it's been
+        invalidated.'''
+        if self._sensorTreeRows is None:
+            ps = self.sensorPositions()
+            rs = self.sensorRadii()
+            rows = numpy.flatnonzero(numpy.isfinite(ps).all(axis=1) & numpy.isfinite(rs))
+            self._sensorTreeRows = rows
+            if len(rows) > 0:
+                self._sensorTree = cKDTree(ps[rows])
+
+
+    def sensorAdded(self, s: Sensor):
+        '''Note that a sensor has been added to an agent in the playground.
+        This is called automatically by :meth:`Agent.addSensor`.
+
+        :param s: the sensor'''
+        if not self._dirty:
+            # defer until the arrays are next used, as the sensor
+            # may not be fully initialised yet
+            self._pendingSensors.append(s)
+
+
+    def sensorRemoved(self, s: Sensor):
+        '''Note that a sensor has been removed from an agent in the playground.
+        This is called automatically by :meth:`Agent.removeSensor`.
+
+        :param s: the sensor'''
+        self._invalidateSensorArrays()
+
+
+    def allSensors(self) -> List[Sensor]:
+        '''Return all the sensors attached to agents in the playground,
+        in the order of the rows of :meth:`sensorPositions` and
+        :meth:`sensorRadii`.
+
+        :returns: the sensors'''
+        self._buildSensorArrays()
+        return self._sensors
+
+
+    def allSensorsWithModality(self, m: Type) -> List[Sensor]:
+        '''Return all the sensors in the playground having the given modality.
+
+        :param m: the modality
+        :returns: the sensors'''
+        return [s for s in self.allSensors() if isinstance(s, m)]
+
+
+    def sensorIndex(self, s: Sensor) -> int:
+        '''Return the row of the sensor arrays holding the given sensor.
+
+        A KeyError will be raised if the sensor isn't in the playground.
+
+        :param s: the sensor
+        :returns: the index'''
+        self._buildSensorArrays()
+        return self._indexOf[s]
+
+
+    def sensorPositions(self) -> numpy.ndarray:
+        '''Return the (N, d) array of sensor positions.
+
+        The array is owned by the playground and is updated in place
+        as agents move, so callers needing a snapshot should copy it.
+
+        :returns: the positions'''
+        self._buildSensorArrays()
+        return self._positions
+
+
+    def sensorRadii(self) -> numpy.ndarray:
+        '''Return the (N,) array of sensor detection radii.
+
+        :returns: the radii'''
+        self._buildSensorArrays()
+        return self._radii
+
+
+    def sensorSquaredRadii(self) -> numpy.ndarray:
+        '''Return the (N,) array of squared sensor detection radii,
+        against which squared distances can be compared directly.
+
+        :returns: the squared radii'''
+        self._buildSensorArrays()
+        return self._radii2
+
+
+    def sensorSquaredNorms(self) -> numpy.ndarray:
+        '''Return the (N,) array of the squared norms of the sensor
+        positions.
+
+        These are kept in step with :meth:`sensorPositions`, so
+        that distance computations using the matrix-product form
+        don't need to re-compute them for every query.
+
+        :returns: the squared norms'''
+        self._buildSensorArrays()
+        return self._norms2
 
 
     # ---------- Search functions ----------
@@ -264,21 +628,38 @@ class SensorPlayground:
         If the agent also has sensors of a potentially observing type attached
         to it, they will be returned as well.
 
+        The agent is tested against all the sensors' detection radii at
+        once using the sensor arrays. For large numbers of sensors the
+        candidates are first found using a k-d tree over the sensors'
+        positions, as those within the largest radius of the agent.
+        Sensors without a detection radius are never returned.
+
         :param a: the agent
         :param cls: (optional) the class of sensor making the observations
         :returns: the sensors
 
         '''
-        p = a.position()
-
-        # find all agents in whose bounding box we sit
-        coords = tuple(p + p)
-        possibleAgents = [self._getAgent(i) for i in self._boxes.intersection(coords)]
-        print(possibleAgents)
+        p = a.positionVector()
+        ps = self.sensorPositions()
+        r2s = self.sensorSquaredRadii()
+
+        # find the candidate sensors, either from the k-d tree
+        # or by checking them all
+        if len(ps) >= self.KDTREE_THRESHOLD:
+            self._buildSensorIndex()
+            if self._sensorTree is None:
+                # no positioned sensors with radii
+                return []
+            idxs = self._sensorTree.query_ball_point(p, numpy.sqrt(r2s[self._sensorTreeRows].max()))
+            idxs = self._sensorTreeRows[idxs]
+        else:
+            idxs = numpy.arange(len(ps))
 
-        # extract all sensors from these agents
-        ss = [a.sensors() for a in possibleAgents]
-        possibleSensors = set.union(*ss)
+        # refine to the sensors within whose detection radius we sit
+        diff = ps[idxs] - p
+        d2 = numpy.einsum('ij,ij->i', diff, diff)
+        ss = self._sensors
+        possibleSensors = [ss[i] for i in idxs[d2 < r2s[idxs]]]
 
         # reduce by type
         if cls is not None:
@@ -297,12 +678,18 @@ class SensorPlayground:
         return self._eventId
 
 
-    def postEvent(self, t: float, sa: Union[Sensor, Agent], f: EventFunction):
-        '''Postan event for the given time.
+    def postEvent(self, sa: Union[Sensor, Agent], t: float, f: EventFunction):
+        '''Post an event for the given time.
+
+        Events are held in a heap ordered by time and then by the
+        order in which they were posted, so events posted for the
+        same time are executed in the order they were posted.
 
-        :param t: the event time (must be in the future)
         :param sa: the agent or sensor that will receive the event
+        :param t: the event time (must not be in the past)
         :param f: the event functionto be called'''
+        if t < self._simulationTime:
+            raise ValueError(f'Posting event at time {t}, which is before the current time {self._simulationTime}')
         ev = [t, self._newEventId(), sa, f]
         heappush(self._events, ev)
 
@@ -326,6 +713,16 @@ class SensorPlayground:
         ev[2] = None
 
 
+    def hasEvents(self) -> bool:
+        '''Test whether there are any events left to execute. Any
+        deleted events at the head of the queue are discarded.
+
+        :returns: True if there are events pending'''
+        while len(self._events) > 0 and self._isDeletedEvent(self._events[0]):
+            heappop(self._events)
+        return len(self._events) > 0
+
+
     def nextEvent(self,) -> Event:
         '''Pop the next event and return it.
 
@@ -339,6 +736,43 @@ class SensorPlayground:
         return None
 
 
+    # ---------- Batched sampling ----------
+
+    # When several sensors sample at the same simulation time it's
+    # usually cheaper to count all their targets together in a single
+    # vectorised pass than sensor-by-sensor. The simulation loop gathers
+    # the sample events due at each time and, where two or more are for
+    # instances of SimpleTargetCountSensor, counts for them all at once
+    # using SimpleTargetCountSensor.countAllTargets(). The counts
+    # are held until each sensor's own sample event collects them, and
+    # are discarded along with the proximity index if any agent moves
+    # in the meantime, so the sensor then counts for itself.
+
+    def _prepareSamples(self, evs: List[Event]):
+        '''Count the targets for all the sensors with sample events
+        amongst the given events.
+
+        Only events that call the sample() method of the sensor
+        they were posted for are batched.
+
+        :param evs: the events'''
+        ss = [sa for (_, _, sa, f) in evs
+              if isinstance(sa, SimpleTargetCountSensor) and f == sa.sample]
+        if len(ss) > 1:
+            cs = SimpleTargetCountSensor.countAllTargets(ss)
+            self._sampledCounts.update(zip(ss, cs.tolist()))
+
+
+    def sampledCount(self, s: Sensor) -> Optional[int]:
+        '''Collect the number of targets counted for a sensor as
+        part of a batch of samples at the current time. The count
+        is only returned once.
+
+        :param s: the sensor
+        :returns: the number of targets, or None if not counted'''
+        return self._sampledCounts.pop(s, None)
+
+
     # ---------- Discrete-event simulation ----------
 
     def now(self) -> int:
@@ -354,6 +788,10 @@ class SensorPlayground:
         or other functions.
 
         :param t: the simulation time'''
+        if t != self._simulationTime:
+            # mobile agents may have moved
+            self._invalidateProximityIndex()
+            self._invalidateSensorArrays()
         self._simulationTime = t
 
 
@@ -361,7 +799,7 @@ class SensorPlayground:
         '''Set the maximum permitted simulation time.
 
         :param t: the maximum simulation time'''
-        self._maximumTime = t
+        self._maximumSimulationTime = t
 
 
     def run(self) -> int:
@@ -376,11 +814,19 @@ class SensorPlayground:
                 # no more events to handle
                 break
 
-            # handle the event
-            # TODO: change this to access the list directly -- obscure but faster
-            (_, t, sa, f) = ev
+            # gather all the other events due at the same time
+            t = ev[0]
+            self._dueEvents = [ev]
+            while self.hasEvents() and self._events[0][0] == t:
+                self._dueEvents.append(heappop(self._events))
             self.setSimulationTime(t)
-            f(t)
-            n += 1
+            self._prepareSamples(self._dueEvents)
+
+            # handle the events, skipping any deleted by earlier ones
+            for ev in self._dueEvents:
+                if not self._isDeletedEvent(ev):
+                    ev[3](t)
+                    n += 1
+            self._dueEvents = []
 
         return n
@@ -18,9 +18,9 @@
 # You should have received a copy of the GNU General Public License
 # along with this software. If not, see <http://www.gnu.org/licenses/gpl.html>.
 
+import math
 import numpy
-from numpy.linalg import norm
-from typing import List, Union, Tuple, cast
+from typing import List, Union, Tuple, Iterable, Optional
 
 
 # ---------- Positions and helper functions ----------
@@ -51,23 +51,87 @@ def haveSameDimensions(p1: Position, p2: Position, fatal: bool = True):
 
 
 def vectorPosition(p: Position) -> numpy.ndarray:
-    '''Ensure p is a numpy vector.
+    '''Ensure p is a numpy vector of floats. This doesn't
+    copy p if it is already such a vector.
 
-    :param p: the position, as a vector or list.
+    :param p: the position, as a vector, list, or tuple
     :returns: the position as a vector'''
-    if type(p) is list or type(p) is tuple:
-        return numpy.array(p)
-    return cast(numpy.ndarray, p)
+    return numpy.asarray(p, dtype=numpy.float64)
+
+
+def distance2d(p: Position, q: Position) -> float:
+    '''Return the distance between two points in 2-space.
+
+    This uses scalar arithmetic rather than numpy, which is
+    far faster for individual points.
+
+    :param p: one position
+    :param q: the other position
+    :returns: the distance'''
+    return math.hypot(p[0] - q[0], p[1] - q[1])
+
+
+def distance3d(p: Position, q: Position) -> float:
+    '''Return the distance between two points in 3-space.
+
+    This uses scalar arithmetic rather than numpy, which is
+    far faster for individual points.
+
+    :param p: one position
+    :param q: the other position
+    :returns: the distance'''
+    dx = p[0] - q[0]
+    dy = p[1] - q[1]
+    dz = p[2] - q[2]
+    return math.sqrt(dx * dx + dy * dy + dz * dz)
 
 
 def distanceBetween(p: Position, q: Position) -> float:
     '''Return the distance between two points. The points must
     have the same dimensions.
 
+    Points in 2- and 3-space (the common cases) are handled
+    using scalar arithmetic; other points use numpy, converting
+    both points in a single subtraction rather than separately.
+
     :param p: one position
     :param q: the other position
     :returns: the distance'''
-    return float(norm(vectorPosition(p) - vectorPosition(q)))
+    d = len(p)
+    if d == len(q):
+        if d == 2:
+            return distance2d(p, q)
+        elif d == 3:
+            return distance3d(p, q)
+    diff = numpy.subtract(p, q, dtype=numpy.float64)
+    return math.sqrt(float(diff @ diff))
+
+
+def distanceSquaredBetween(p: Position, q: Position) -> float:
+    '''Return the squared distance between two points. The points
+    must have the same dimensions.
+
+    This avoids the square root needed by :func:`distanceBetween`,
+    and so is preferable when comparing a distance against a
+    (squared) threshold. Points in 2- and 3-space are handled
+    using scalar arithmetic; other points use numpy.
+
+    :param p: one position
+    :param q: the other position
+    :returns: the squared distance'''
+    d = len(p)
+    if d == len(q):
+        if d == 2:
+            dx = p[0] - q[0]
+            dy = p[1] - q[1]
+            return dx * dx + dy * dy
+        elif d == 3:
+            dx = p[0] - q[0]
+            dy = p[1] - q[1]
+            dz = p[2] - q[2]
+            return dx * dx + dy * dy + dz * dz
+    diff = numpy.subtract(p, q, dtype=numpy.float64)
+    return float(diff @ diff)
 
 
 # ---------- Bounding boxes ----------
@@ -82,26 +146,26 @@ class BoundingBox:
     A bounding box is an open area: it doesn't include its boundary. However,
     it it's just a point, it does contain that point.
 
+    The corners are held as numpy vectors, so tests against the box
+    work on all dimensions at once.
+
     :param c1: one corner position
     :param c2: (optional) the other corner position'''
 
     def __init__(self, c1: Position, c2: Position = None):
-        # if we have two corners, they have to have the same dimensions
-        if c2 is not None:
-            haveSameDimensions(c1, c2)
-
-        if c2 is None or c1 == c2:
-            # if the second corner is missing or the same as the first,
-            # the box is a point
+        c1 = vectorPosition(c1)
+        if c2 is None:
+            # if the second corner is missing the box is a point
             self._topRight = c1
             self._bottomLeft = c1
         else:
+            # if we have two corners, they have to have the same dimensions
+            haveSameDimensions(c1, c2)
+
             # compute the bounding box from the two corners
-            self._topRight: Position = []
-            self._bottomLeft: Position = []
-            for d in range(len(c1)):
-                self._topRight.append(max(c1[d], c2[d]))
-                self._bottomLeft.append(min(c1[d], c2[d]))
+            c2 = vectorPosition(c2)
+            self._topRight: numpy.ndarray = numpy.maximum(c1, c2)
+            self._bottomLeft: numpy.ndarray = numpy.minimum(c1, c2)
 
 
     # ---------- Access ----------
@@ -113,23 +177,31 @@ class BoundingBox:
         return len(self._topRight)
 
 
-    def corners(self) -> Tuple[Position, Position]:
+    def corners(self) -> Tuple[numpy.ndarray, numpy.ndarray]:
         '''Return the two corners of the bounding box.
 
         :returns: a pair of corners'''
         return (self._bottomLeft, self._topRight)
 
 
+    def __iter__(self) -> Iterable[numpy.ndarray]:
+        '''Iterate over the corners of the bounding box, allowing
+        them to be unpacked directly.
+
+        :returns: an iterator over the corners'''
+        return iter(self.corners())
+
+
     def isPoint(self) -> bool:
         '''Test if the bounding box is just a point.
 
         :returns: True if the bounding box contains only a single point'''
-        return (self._bottomLeft == self._topRight)
+        return bool((self._bottomLeft == self._topRight).all())
 
 
     # ---------- Tests ----------
 
-    def contains(self, p: Position) -> bool:
+    def contains(self, p: Union[Position, numpy.ndarray]) -> Union[bool, numpy.ndarray]:
         '''True if the given point is within the bounding box.
 
         The bounding box doesn't contain its boundary *unless* it
@@ -142,19 +214,32 @@ class BoundingBox:
         (describing a closed region instead of an open one, in
         other words).
 
-        :param p: the point to test
+        The point may also be an (N, d) array of points, in which
+        case they're all tested at once and the result is an (N,)
+        array of booleans.
+
+        :param p: the point or points to test
         :returns: True if the point is within the bounding box'''
-        haveSameDimensions(self._topRight, p)
+        bl = self._bottomLeft
+        tr = self._topRight
 
-        for d in range(len(p)):
-            if self._topRight[d] == self._bottomLeft[d]:
-                # zero depth in this dimension
-                if p[d] != self._topRight[d]:
-                    return False
-            else:
-                if p[d] >= self._topRight[d] or p[d] <= self._bottomLeft[d]:
-                    return False
-        return True
+        if isinstance(p, numpy.ndarray) and p.ndim == 2:
+            if p.shape[1] != len(tr):
+                raise ValueError(f"Points of dimension {p.shape[1]} can't be in a box of dimension {len(tr)}")
+
+            # same test as below, reduced along each row
+            inside = numpy.where(bl == tr, p == tr, (p > bl) & (p < tr))
+            return inside.all(axis=1)
+
+        if len(p) != len(tr):
+            # only go through the full check to raise the exception
+            haveSameDimensions(tr, p)
+
+        # in dimensions with zero depth the point has to lie on the box,
+        # otherwise it has to lie strictly between the sides
+        p = vectorPosition(p)
+        inside = numpy.where(bl == tr, p == tr, (p > bl) & (p < tr))
+        return bool(inside.all())
 
 
     def __contains__(self, p: Position) ->bool:
@@ -183,14 +268,9 @@ class BoundingBox:
             raise ValueError(f"Bounding boxes have different dimensions ({d} and {bd})")
 
         # compute the bounding box from the two corners
-        tr: Position = []
-        bl: Position = []
         (bl1, tr1) = self.corners()
         (bl2, tr2) = bb.corners()
-        for d in range(len(tr1)):
-            tr.append(max(tr1[d], tr2[d]))
-            bl.append(min(bl1[d], bl2[d]))
-        return BoundingBox(bl, tr)
+        return BoundingBox(numpy.minimum(bl1, bl2), numpy.maximum(tr1, tr2))
 
 
 # ---------- Trajectories ----------
@@ -227,14 +307,34 @@ class Trajectory:
         if startt >= endt:
             raise ValueError(f'Trajectory start time ({startt}) is later than its end time ({endt})')
 
+        self._dim = len(startp)
         self._startp = startp
         self._startt = startt
         self._endp = endp
         self._endt = endt
+        self._computeInvariants()
+
+
+    def _computeInvariants(self):
+        '''Pre-compute the quantities used for interpolation, which
+        only change when the trajectory itself changes.'''
+        self._dur = self._endt - self._startt
+        self._invDur = 1.0 / self._dur if self._dur > 0 else 0.0
+        self._p0 = vectorPosition(self._startp)
+        self._p1 = vectorPosition(self._endp)
+        self._delta = self._p1 - self._p0
+        self._boundingBox = None
 
 
     # ---------- Access ----------
 
+    def dimension(self) -> int:
+        '''Return the dimension of the space the trajectory moves in.
+
+        :returns: the number of dimensions'''
+        return self._dim
+
+
     def interval(self) -> Tuple[float, float]:
         '''Return the interval between start and end times.
 
@@ -258,10 +358,9 @@ class Trajectory:
         :param t: the time
         :param fatal: (optional) raise an exception if outside (defaults to False)
         :returns: True if t lies within the motion interval'''
-        (s, e) = self.interval()
-        if t < s or t > e:
+        if t < self._startt or t > self._endt:
             if fatal:
-                raise ValueError(f'Requesting a position at tiem {t} outside the motion interval ({s}, {e})')
+                raise ValueError(f'Requesting a position at tiem {t} outside the motion interval ({self._startt}, {self._endt})')
             else:
                 return False
         else:
@@ -270,7 +369,9 @@ class Trajectory:
 
     def isWithinBoundingBox(self, p: Position, fatal: bool = False) -> bool:
         '''Check that the given position lies with the trajectory's
-        bounding box.
+        bounding box. Unlike :meth:`BoundingBox.contains` this includes
+        the box's boundary, so that the trajectory's endpoints are
+        always within it.
 
         If fatal is true an exception is raised if the point
         lies outwith the box.
@@ -278,8 +379,9 @@ class Trajectory:
         :param p: the position
         :param fatal: (optional) raise an exception if outside (defaults to False)
         :returns: True if o lies within the bounding box'''
-        bb = self.boundingBox()
-        if p not in bb:
+        (bl, tr) = self.boundingBox().corners()
+        p = vectorPosition(p)
+        if not ((p >= bl) & (p <= tr)).all():
             if fatal:
                 raise ValueError('Point lies outside bounding box')
             else:
@@ -300,14 +402,44 @@ class Trajectory:
         :param t: the simulation time
         :returns: the interpolated position'''
 
-        # check time
-        self.isWithinInterval(t, fatal=True)
+        # check time, only going through the full check to raise the exception
+        if t < self._startt or t > self._endt:
+            self.isWithinInterval(t, fatal=True)
 
         # linearly interpolate the motion
-        (s, e) = self.interval()
-        dt = t / (e - s)
-        p = [self._startp[i] + (self._endp[i] - self._startp[i]) * dt for i in range(len(self._startp))]
-        return p
+        dt = (t - self._startt) * self._invDur
+        return (self._p0 + self._delta * dt).tolist()
+
+
+    def positions(self, ts: Iterable[float]) -> numpy.ndarray:
+        '''Return the interpolated positions along the trajectory at
+        several times at once.
+
+        The default is constant linear motion, consistent with
+        :meth:`positionAt`, and may be overridden by sub-classes.
+
+        An exception is raised if any of the times lie outside the
+        motion interval.
+
+        :param ts: the simulation times
+        :returns: an (N, d) array of positions'''
+        ts = numpy.asarray(ts, dtype=numpy.float64)
+        if ts.size > 0 and (ts.min() < self._startt or ts.max() > self._endt):
+            raise ValueError(f'Requesting positions at times outside the motion interval ({self._startt}, {self._endt})')
+
+        # linearly interpolate the motion at all the times
+        dts = (ts - self._startt) * self._invDur
+        return self._p0 + self._delta * dts[:, numpy.newaxis]
+
+
+    def position(self, t: float) -> Position:
+        '''Return the position along the trajectory at the given time.
+
+        This is a synonym for :meth:`positionAt`.
+
+        :param t: the simulation time
+        :returns: the interpolated position'''
+        return self.positionAt(t)
 
 
     def advanceTo(self, t: float):
@@ -315,40 +447,137 @@ class Trajectory:
         the given time.
 
         :param t: the new time'''
-        self._startp = self.positionAt(t)
-        self._startt = t
+        if t != self._startt:
+            self._startp = self.positionAt(t)
+            self._startt = t
+            self._computeInvariants()
 
 
     def boundingBox(self) -> BoundingBox:
         '''Return the bounding box for the trajectory.
 
         By default this is bounded by the endpoints, which
-        may be overridden by sub-classses.
+        may be overridden by sub-classses. The box is computed
+        when first requested and then cached until the trajectory
+        changes.
 
         :returns: the bounding box'''
-        return BoundingBox(self._startp, self._endp)
+        if self._boundingBox is None:
+            self._boundingBox = BoundingBox(self._p0, self._p1)
+        return self._boundingBox
 
 
-    def entersLeavesAt(self, bb: BoundingBox) -> Tuple[float, float]:
-        '''Return the time at which the agent following this trajectory
+    def entersLeavesAt(self, bb: BoundingBox) -> Optional[Tuple[float, float]]:
+        '''Return the times at which the agent following this trajectory
         will enter and leave the given bounding box.
 
-        For the time being we assume this is the first time for both.
+        The times are computed directly from the intersection of the
+        line of motion with the slabs between the box's sides in each
+        dimension, and are clipped to the motion interval. A trajectory
+        that starts (or ends) inside the box enters (or leaves) it at
+        its start (or end) time.
 
         :param bb: the bounding box
-        :returns: the time'''
-
-        # compute all the times
-        dt = (self._endt - self._startt)
-        cs = bb.corners()
-        bd = len(cs[0])
-        ts = []
-        for d in range(bd):
-            for i in range(len(cs)):
-                t = (cs[0][i] - self._startp[d]) / dt
-                ts.append(t)
-
-        # entry time is the smallest positive time, exit is the next largest
-        sts = [t for t in ts if t >= 0]
-        sts.sort()
-        return (sts[0], sts[1])
+        :returns: the entry and exit times, or None if the trajectory never enters the box'''
+        (bl, tr) = bb.corners()
+        if len(bl) != self._dim:
+            haveSameDimensions(bl, self._p0)
+
+        # in dimensions with no motion the trajectory has to lie
+        # within the box's extent throughout
+        moving = self._delta != 0
+        p0 = self._p0[~moving]
+        inside = numpy.where(bl[~moving] == tr[~moving],
+                             p0 == tr[~moving],
+                             (p0 > bl[~moving]) & (p0 < tr[~moving]))
+        if not inside.all():
+            return None
+
+        # in the other dimensions find the fraction of the motion at
+        # which the trajectory crosses each side, and so the range
+        # for which it lies between both sides in all dimensions
+        p0 = self._p0[moving]
+        delta = self._delta[moving]
+        a1 = (bl[moving] - p0) / delta
+        a2 = (tr[moving] - p0) / delta
+        enter = max(numpy.minimum(a1, a2).max(initial=0.0), 0.0)
+        leave = min(numpy.maximum(a1, a2).min(initial=1.0), 1.0)
+        if enter >= leave:
+            return None
+        return (self._startt + enter * self._dur, self._startt + leave * self._dur)
+
+
+class TrajectoryArray:
+    '''A collection of linear trajectories held as contiguous arrays.
+
+    The array stores the start points and displacements of its
+    trajectories in single-precision buffers, so that many targets'
+    positions can be interpolated (or fused with detection) in a single
+    operation. The start times and reciprocal durations are kept in
+    double precision, as simulation times can become large enough that
+    single precision can't resolve the motion. Sub-classes of
+    :class:`Trajectory` that don't move linearly are treated as though
+    they did.
+
+    The array takes a snapshot of the trajectories when it's created.
+    If they subsequently change (for example by being advanced),
+    :meth:`refresh` will re-read them.
+
+    :param js: the trajectories'''
+
+    def __init__(self, js: Iterable[Trajectory]):
+        self._trajectories: List[Trajectory] = list(js)
+        self.refresh()
+
+
+    def refresh(self):
+        '''Re-read the endpoints and intervals of the trajectories.'''
+        n = len(self._trajectories)
+        if n == 0:
+            self._startps = numpy.empty((0, 0), dtype=numpy.float32)
+            self._deltas = numpy.empty((0, 0), dtype=numpy.float32)
+        else:
+            eps = [j.endpoints() for j in self._trajectories]
+            self._startps = numpy.ascontiguousarray([p for (p, _) in eps], dtype=numpy.float32)
+            self._deltas = numpy.ascontiguousarray([q for (_, q) in eps], dtype=numpy.float32) - self._startps
+        ivs = numpy.asarray([j.interval() for j in self._trajectories], dtype=numpy.float64).reshape((n, 2))
+        self._startts = ivs[:, 0]
+        self._invDurs = 1.0 / (ivs[:, 1] - ivs[:, 0])
+
+
+    # ---------- Access ----------
+
+    def __len__(self) -> int:
+        '''Return the number of trajectories in the array.
+
+        :returns: the number of trajectories'''
+        return len(self._trajectories)
+
+
+    def trajectories(self) -> List[Trajectory]:
+        '''Return the trajectories, in the order of the rows of the arrays.
+
+        :returns: the trajectories'''
+        return self._trajectories
+
+
+    def arrays(self) -> Tuple[numpy.ndarray, numpy.ndarray, numpy.ndarray, numpy.ndarray]:
+        '''Return the arrays describing the trajectories, being
+        the (N, d) start points, the (N, d) displacements, the (N,)
+        start times, and the (N,) reciprocals of the durations.
+
+        :returns: a tuple of arrays'''
+        return (self._startps, self._deltas, self._startts, self._invDurs)
+
+
+    # ---------- Interpolation ----------
+
+    def positionsAt(self, t: float) -> numpy.ndarray:
+        '''Return the positions of all the trajectories at the given time.
+        Trajectories whose motion interval doesn't include t are placed
+        at their nearer endpoint.
+
+        :param t: the simulation time
+        :returns: an (N, d) array of positions'''
+        alphas = numpy.clip((t - self._startts) * self._invDurs, 0.0, 1.0).astype(self._startps.dtype)
+        return self._startps + self._deltas * alphas[:, numpy.newaxis]
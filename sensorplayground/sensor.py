@@ -18,11 +18,13 @@
 # You should have received a copy of the GNU General Public License
 # along with this software. If not, see <http://www.gnu.org/licenses/gpl.html>.
 
+import logging
 import numpy
-from numpy.linalg import norm
-from typing import List, Union, Any, Iterable,Type, cast
+from itertools import chain
+from typing import List, Dict, Union, Any, Iterable,Type, cast
 import sensorplayground
-from sensorplayground import Position, distanceBetween, BoundingBox, TargetCount, TargetTrigger
+from sensorplayground import Position, distanceSquaredBetween, BoundingBox, TrajectoryArray, TargetCount, TargetTrigger
+from sensorplayground.kernels import detectAll, countAll, withinRadius, advanceAndDetect
 
 # There is a circular import between Agent and SensorPlayground at the
 # typing level (but not at the execution level), when providing types
@@ -34,6 +36,9 @@ if TYPE_CHECKING:
     from sensorplayground import Agent
 
 
+logger = logging.getLogger(__name__)
+
+
 class Sensor:
     '''A sensor attached to an agent.
 
@@ -77,7 +82,7 @@ class Sensor:
         :param a: the agent'''
 
         # detach from previous agent if there is one
-        if self._agent is not None:
+        if self._agent is not None and self._agent is not a:
             self._agent.removeSensor(self)
         self._agent = a
 
@@ -89,6 +94,13 @@ class Sensor:
         return self.agent().position()
 
 
+    def positionVector(self) -> numpy.ndarray:
+        '''The sensor's position as a numpy vector is that of its agent.
+
+        :returns: the position'''
+        return self.agent().positionVector()
+
+
     def distanceTo(self, a: 'Agent') -> float:
         '''The distance to another agent is its distance from this
         sensor's agent.
@@ -116,6 +128,71 @@ class Sensor:
         return None
 
 
+    # ---------- Detection ----------
+
+    def canDetectTarget(self, q: Position) -> bool:
+        '''Test whether the sensor can detect a target at position q.
+
+        This method should be overridden by sub-classes.
+
+        :param q: the position of the target
+        :returns: True if the target is detectable by this sensor'''
+        raise NotImplementedError('canDetectTarget')
+
+
+    def _maskBatch(self, qs: numpy.ndarray) -> numpy.ndarray:
+        '''Test which of an array of target positions the sensor
+        can detect.
+
+        The default calls :meth:`canDetectTarget` for each position.
+        Sub-classes should override this with a vectorised test
+        where possible.
+
+        :param qs: an (N, d) array of target positions
+        :returns: an (N,) boolean mask of detectable targets'''
+        return numpy.fromiter((self.canDetectTarget(q) for q in qs),
+                              dtype=bool, count=len(qs))
+
+
+    def detects(self, ts: Iterable[Position]) -> Union[List[Position], numpy.ndarray]:
+        '''Return the targets that this sensor can detect.
+
+        The targets are always tested in a single batch. If they are
+        given as an (N, d) array the result is an array of the detected
+        positions; otherwise it's a list of the detected targets.
+
+        :param ts: the target positions
+        :returns: the detected target positions'''
+        if isinstance(ts, numpy.ndarray) and ts.ndim == 2:
+            return ts[self._maskBatch(ts)]
+        else:
+            if not isinstance(ts, (list, tuple)):
+                ts = list(ts)
+            if len(ts) == 0:
+                return []
+            mask = self._maskBatch(numpy.ascontiguousarray(ts, dtype=numpy.float64))
+            return [q for (q, m) in zip(ts, mask) if m]
+
+
+    def counts(self, ts: Iterable[Position]) -> int:
+        '''Return the number of targets that this sensor can detect.
+
+        This doesn't construct the detected targets, and counts
+        directly from the detection mask.
+
+        :param ts: the target positions
+        :returns: the count'''
+        if not isinstance(ts, numpy.ndarray):
+            # sequences go straight into the array, other iterables
+            # need to be consumed first
+            if not isinstance(ts, (list, tuple)):
+                ts = list(ts)
+            if len(ts) == 0:
+                return 0
+            ts = numpy.ascontiguousarray(ts, dtype=numpy.float64)
+        return int(numpy.count_nonzero(self._maskBatch(ts)))
+
+
     # ---------- Event interface ----------
 
     def sample(self, t: float):
@@ -152,27 +229,72 @@ class SimpleTargetCountSensor(Sensor, TargetCount, TargetTrigger):
                  cls: Type['Agent'] = None, id: Any = None):
         super().__init__(a, id=id)
         self._detectionRadius = r
+        self._r2 = r * r
         self._targets = 0
         self._cls = cls
+        self._fovCache = None
 
 
     def detectionRadius(self) -> float:
         return self._detectionRadius
 
 
+    def setAgent(self, a: 'Agent'):
+        '''Associate the sensor with the given agent, discarding
+        the cached field of view.
+
+        :param a: the agent'''
+        super().setAgent(a)
+        self._fovCache = None
+
+
     def fieldOfView(self) -> BoundingBox:
         '''Return the sensor's bounding box based on its position
         and detection radius.
 
+        The bounding box is cached against the position it was
+        computed for, so it's only re-computed when the sensor moves.
+
         :returns: the bounding box'''
         p = self.position()
-        r = self.detectionRadius()
-        bl = p.copy()
-        tr = p.copy()
-        for i in range(len(p)):
-            bl[i] = p[i] - r
-            tr[i] = p[i] + r
-        return BoundingBox(bl, tr)
+        key = tuple(p)
+        if self._fovCache is None or self._fovCache[0] != key:
+            v = self.positionVector()
+            r = self._detectionRadius
+            self._fovCache = (key, BoundingBox(v - r, v + r))
+        return self._fovCache[1]
+
+
+    # ---------- Detection ----------
+
+    def canDetectTarget(self, q: Position) -> bool:
+        '''Detects a target if it is (strictly) within the sensing field radius.
+
+        :param q: the position of the target
+        :returns: True if the target is detectable by this sensor'''
+        return distanceSquaredBetween(self.position(), q) < self._r2
+
+
+    def _maskBatch(self, qs: numpy.ndarray) -> numpy.ndarray:
+        '''Test which of an array of target positions lie within the
+        sensing field, comparing squared distances.
+
+        :param qs: an (N, d) array of target positions
+        :returns: an (N,) boolean mask of detectable targets'''
+        diff = qs - self.positionVector()
+        return numpy.einsum('ij,ij->i', diff, diff) < self._r2
+
+
+    # ---------- Overlaps ----------
+
+    def isOverlappingWith(self, s: 'SimpleTargetCountSensor') -> bool:
+        '''Test whether this sensor's field overlaps with that of another
+        sensor. Fields that only touch don't overlap.
+
+        :param s: the other sensor
+        :returns: True if the sensor fields overlap'''
+        r = self.detectionRadius() + s.detectionRadius()
+        return distanceSquaredBetween(self.position(), s.position()) < r * r
 
 
     # ---------- Modalities ----------
@@ -205,24 +327,212 @@ class SimpleTargetCountSensor(Sensor, TargetCount, TargetTrigger):
         '''Count the targets within range of the sensor.
 
         This involves finding all targets within the sensor's detection
-        radius (first using a bounding box, then refining), and then
-        checking whether each target is actually detected based on its
-        position. The number of targets is recorded for retrieval
-        using :meth:`numberOfTargets`.
+        radius (first using the playground's proximity index, then refining
+        to exclude the boundary), and then checking whether each target is
+        actually detected based on its position. The number of targets is
+        recorded for retrieval using :meth:`numberOfTargets`.
+
+        If the sensor's targets have already been counted as part of
+        a batch of sensors sampling at the same time (see
+        :meth:`countAllTargets`) then that count is used directly.
 
         :param t: simulation time (ignored)'''
+        n = self.playground().sampledCount(self)
+        self._targets = n if n is not None else self._countTargets()
+
+
+    def _countTargets(self) -> int:
+        '''Count the targets within range of the sensor that it
+        actually detects.
+
+        :returns: the number of targets'''
         r = self.detectionRadius()
+        a = self.agent()
+        p = a.positionVector()
 
         # retrieve all potentially-detected targets
-        observables = self.playground().allAgentsWithinFieldOfView(self, cls=self._cls)  # in bounding box
-        targets = [t for t in observables if self.distanceTo(t) < r]                     # within distance
-        print(self)
-        print(targets)
-        print(f'{len(targets)} targets observed')
-
-        # determine which targets are detected
-        detected = [t for t in targets if self.detectsTarget(t)]
-        print(f'{len(detected)} targets detected')
-
-        # record the detected targets
-        self._targets = len(detected)
+        observables = [o for o in self.playground().allAgentsWithinDistance(p, r, cls=self._cls)
+                       if o != a]                                                              # within closed ball
+        n = len(observables)
+        if n > 0:
+            # refine to those within distance, gathering all the targets'
+            # positions in one pass and testing them at once, and count
+            # those in range that are actually detected
+            d = len(p)
+            qs = numpy.fromiter(chain.from_iterable(o.position() for o in observables),
+                                dtype=numpy.float64, count=n * d).reshape((n, d))
+            mask = withinRadius(p, self._r2, qs)
+            idxs = numpy.nonzero(mask)[0]
+            detected = sum(1 for i in idxs if self.detectsTarget(observables[i]))
+        else:
+            idxs = []
+            detected = 0
+        logger.debug('%s observed %d targets, detected %d', self, len(idxs), detected)
+        return detected
+
+
+    @classmethod
+    def countAllTargets(cls, ss: Iterable['SimpleTargetCountSensor']) -> numpy.ndarray:
+        '''Count the targets detected by a collection of sensors
+        in the same playground.
+
+        This gives the same counts as calling :meth:`sample` for each
+        sensor. Sensors that detect every target in range are counted
+        together using :func:`countAll`, in batches by the class of
+        targets they detect, gathering the positions of the sensors and
+        the targets only once. Sensors that override :meth:`detectsTarget`
+        have to check each target, and so are counted individually.
+        Sensors whose agents have no position detect no targets.
+        The playground uses this to batch sensors that sample at the
+        same time.
+
+        :param ss: the sensors
+        :returns: a (K,) array of the numbers of targets detected'''
+        ss = list(ss)
+        cs = numpy.zeros(len(ss), dtype=int)
+        if len(ss) == 0:
+            return cs
+        (agents, qs) = ss[0].playground().positionedAgents()
+
+        # group the sensors by the class of targets they detect,
+        # leaving unpositioned sensors detecting nothing
+        batches: Dict[Type['Agent'], List[int]] = dict()
+        for (i, s) in enumerate(ss):
+            if s.agent().positionVector() is None:
+                continue
+            elif type(s).detectsTarget is SimpleTargetCountSensor.detectsTarget:
+                batches.setdefault(s._cls, []).append(i)
+            else:
+                cs[i] = s._countTargets()
+
+        # count each batch against the targets of its class
+        for (tcls, idxs) in batches.items():
+            bs = [ss[i] for i in idxs]
+            if tcls is None:
+                tqs = qs
+            else:
+                tqs = qs[[j for (j, o) in enumerate(agents) if isinstance(o, tcls)]]
+            ps = numpy.asarray([s.agent().positionVector() for s in bs], dtype=numpy.float64)
+            r2s = numpy.asarray([s._r2 for s in bs], dtype=numpy.float64)
+            ns = countAll(ps, r2s, tqs)
+
+            # each sensor's own agent lies at its centre, and so has
+            # been counted if it's of the right class
+            own = [r2 > 0 and (tcls is None or isinstance(s.agent(), tcls))
+                   for (s, r2) in zip(bs, r2s)]
+            cs[idxs] = ns - numpy.asarray(own, dtype=int)
+        return cs
+
+
+# ---------- Arrays of sensors ----------
+
+class SensorArray:
+    '''A collection of sensors held as contiguous arrays.
+
+    The array stores the positions and squared detection radii of
+    its sensors in single-precision buffers (a "structure of arrays"),
+    so that detections for many sensors and many targets can be computed
+    in one call to :func:`detectAll` rather than sensor-by-sensor.
+    All the sensors must provide a :meth:`detectionRadius`.
+
+    The array takes a snapshot of the sensors' positions when it's
+    created. If the sensors subsequently move, :meth:`refresh` will
+    re-read them.
+
+    :param ss: the sensors'''
+
+    def __init__(self, ss: Iterable[Sensor]):
+        self._sensors: List[Sensor] = list(ss)
+        self.refresh()
+
+
+    def refresh(self):
+        '''Re-read the positions and radii of the sensors.'''
+        n = len(self._sensors)
+        if n == 0:
+            self._positions = numpy.empty((0, 0), dtype=numpy.float32)
+            self._radii2 = numpy.empty(0, dtype=numpy.float32)
+            self._norms2 = numpy.empty(0, dtype=numpy.float32)
+        else:
+            self._positions = numpy.ascontiguousarray([s.position() for s in self._sensors],
+                                                      dtype=numpy.float32)
+            rs = numpy.asarray([s.detectionRadius() for s in self._sensors],
+                               dtype=numpy.float32)
+            self._radii2 = rs * rs
+            self._norms2 = numpy.einsum('ij,ij->i', self._positions, self._positions)
+
+
+    # ---------- Access ----------
+
+    def __len__(self) -> int:
+        '''Return the number of sensors in the array.
+
+        :returns: the number of sensors'''
+        return len(self._sensors)
+
+
+    def sensors(self) -> List[Sensor]:
+        '''Return the sensors, in the order of the rows of the arrays.
+
+        :returns: the sensors'''
+        return self._sensors
+
+
+    def positions(self) -> numpy.ndarray:
+        '''Return the (K, d) array of sensor positions.
+
+        :returns: the positions'''
+        return self._positions
+
+
+    def squaredRadii(self) -> numpy.ndarray:
+        '''Return the (K,) array of squared detection radii.
+
+        :returns: the squared radii'''
+        return self._radii2
+
+
+    # ---------- Detection ----------
+
+    def _targetArray(self, ts: Iterable[Position]) -> numpy.ndarray:
+        '''Convert target positions to a contiguous (N, d) array
+        matching the sensors' positions.
+
+        :param ts: the target positions
+        :returns: the array'''
+        qs = numpy.ascontiguousarray(ts, dtype=numpy.float32)
+        if qs.size == 0:
+            qs = qs.reshape((0, self._positions.shape[1]))
+        return qs
+
+
+    def detects(self, ts: Iterable[Position]) -> numpy.ndarray:
+        '''Compute which sensors can detect which targets.
+
+        :param ts: the target positions
+        :returns: a (K, N) boolean matrix, True where sensor i detects target j'''
+        return detectAll(self._positions, self._radii2, self._targetArray(ts), self._norms2)
+
+
+    def counts(self, ts: Iterable[Position]) -> numpy.ndarray:
+        '''Count the targets detectable by each sensor.
+
+        :param ts: the target positions
+        :returns: a (K,) array of counts'''
+        return countAll(self._positions, self._radii2, self._targetArray(ts), self._norms2)
+
+
+    def detectsAt(self, ja: TrajectoryArray, t: float) -> numpy.ndarray:
+        '''Compute which sensors can detect which targets moving
+        along the given trajectories at the given time.
+
+        This interpolates the targets' positions and tests them in a
+        single pass, without creating the positions themselves.
+
+        :param ja: the targets' trajectories
+        :param t: the simulation time
+        :returns: a (K, N) boolean matrix, True where sensor i detects target j'''
+        (p0s, deltas, t0s, invDurs) = ja.arrays()
+        if len(ja) == 0:
+            p0s = deltas = p0s.reshape((0, self._positions.shape[1]))
+        return advanceAndDetect(t, p0s, deltas, t0s, invDurs, self._positions, self._radii2)
@@ -18,12 +18,17 @@
 # You should have received a copy of the GNU General Public License
 # along with this software. If not, see <http://www.gnu.org/licenses/gpl.html>.
 
+from itertools import zip_longest
 from typing import TypeVar, Iterable, Tuple
 
 A = TypeVar('A')
 B = TypeVar('B')
 
 
+# Sentinel marking the end of the shorter iterator
+_MISSING = object()
+
+
 def zipboth(a: Iterable[A], b: Iterable[B]) -> Iterable[Tuple[A, B]]:
     '''Take two iterators and iterate the corresponding pairs.
     Unlike `zip' or `itertools.zip_longest' an exception is raised if the
@@ -32,28 +37,10 @@ def zipboth(a: Iterable[A], b: Iterable[B]) -> Iterable[Tuple[A, B]]:
     :param s: the first iterator
     :param b: the second iterator
     :returns: an iterator over the pairs'''
-    il, ir = iter(a), iter(b)
-    l, r = None, None
-    while True:
-        # get the next value from a
-        try:
-            l = il.__next__()
-        except StopIteration:
-            try:
-                r = ir.__next__()
-            except StopIteration:
-                # both iterators are exhausted, finish
-                return
-
-            # if we get here, a finished before b
+    # pad the shorter iterator and check for the padding
+    for (l, r) in zip_longest(a, b, fillvalue=_MISSING):
+        if l is _MISSING:
             raise ValueError('First iterator finished before the second')
-
-        # get the next value from b
-        try:
-            r = ir.__next__()
-        except StopIteration:
-            # if we get here, b finished before a
+        if r is _MISSING:
             raise ValueError('Second iterator finished before the first')
-
-        # if we get here, return the pair
         yield (l, r)
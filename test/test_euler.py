@@ -19,6 +19,7 @@
 # along with this software. If not, see <http://www.gnu.org/licenses/gpl.html>.
 
 import unittest
+import numpy
 from sensorplayground import *
 
 
@@ -109,6 +110,57 @@ class TestEuler(unittest.TestCase):
         self.assertEqual(c.numberOfSimplicesOfOrder()[2], 1)
 
 
+    def testAddSensors(self):
+        '''Test adding sensors incrementally gives the same structure as a rebuild.'''
+        for p in [[0.25, 0.25], [0.25, 0.35], [0.25, 0.31], [0.3, 0.31], [0.75, 0.75]]:
+            a = Agent()
+            self._playground.addAgent(a)
+            s = SimpleTargetCountSensor(a, r=0.1)
+            a.setPosition(p)
+            self._estimator.addSensor(s)
+
+        c = self._estimator.overhearing()
+        self.assertEqual(c.maxOrder(), 3)
+        self.assertEqual(c.numberOfSimplicesOfOrder()[0], 5)
+        self.assertEqual(c.numberOfSimplicesOfOrder()[1], 6)
+        self.assertEqual(c.numberOfSimplicesOfOrder()[2], 4)
+        self.assertEqual(c.numberOfSimplicesOfOrder()[3], 1)
+
+        self._estimator.rebuild()
+        self.assertEqual(self._estimator.overhearing().numberOfSimplicesOfOrder(),
+                         c.numberOfSimplicesOfOrder())
+
+
+    def testMovingSensors(self):
+        '''Test moving sensors updates the structure in the same way as a rebuild.'''
+        def bases(c):
+            return [set(frozenset(c.basisOf(s)) for s in c.simplicesOfOrder(k))
+                    for k in range(c.maxOrder() + 1)]
+
+        rng = numpy.random.default_rng(7)
+        ss = []
+        for i in range(20):
+            a = Agent()
+            self._playground.addAgent(a)
+            ss.append(SimpleTargetCountSensor(a, r=0.05 + rng.random() * 0.1))
+            a.setPosition(rng.random(2).tolist())
+        self._estimator.rebuild()
+
+        for i in range(40):
+            s = ss[rng.integers(len(ss))]
+            if i % 2 == 0:
+                # move anywhere
+                s.agent().setPosition(rng.random(2).tolist())
+            else:
+                # move to (almost) touch another sensor
+                o = ss[(ss.index(s) + 1) % len(ss)]
+                th = rng.random() * 2 * numpy.pi
+                d = (s.detectionRadius() + o.detectionRadius()) * (1 + (rng.random() - 0.5) * 1e-6)
+                s.agent().setPosition((o.position() + d * numpy.asarray([numpy.cos(th), numpy.sin(th)])).tolist())
+            self.assertEqual(bases(self._estimator.overhearing()),
+                             bases(EulerEstimator(self._playground).overhearing()))
+
+
     # ---------- Target counting ----------
 
     def testOneSensorOneTarget(self):
@@ -223,5 +275,79 @@ class TestEuler(unittest.TestCase):
         self.assertEqual(c, 1)
 
 
+    def testUnpositionedSensor(self):
+        '''Test a sensor without a position doesn't detect any targets.'''
+        for i in range(10):
+            a = Agent()
+            self._playground.addAgent(a)
+            SimpleTargetCountSensor(a, r=0.1)
+            if i > 0:
+                a.setPosition([i * 0.1, 0.0])
+
+        self._estimator.rebuild()
+        c = self._estimator.estimateFromTargets([[5.0 + i, 5.0] for i in range(37)])
+        self.assertEqual(c, 0)
+
+
+    def testUnpositionedSensorLarge(self):
+        '''Test the k-d tree and grid searches ignore a sensor without a position.'''
+        n = EulerEstimator.KDTREE_THRESHOLD + 10
+        for i in range(n):
+            a = Agent()
+            self._playground.addAgent(a)
+            SimpleTargetCountSensor(a, r=0.04)
+            if i > 0:
+                a.setPosition([i * 0.1, 0.0])
+
+        self._estimator.rebuild()
+        c = self._estimator.overhearing()
+        self.assertEqual(c.maxOrder(), 0)
+        self.assertEqual(c.numberOfSimplicesOfOrder()[0], n)
+        qs = [[0.5, 0.0], [1.0, 0.01], [2.0, 0.0]]
+        self.assertEqual(self._estimator.estimateFromTargets(qs), 3)
+
+        # with radii too different to use the grid
+        ps = self._playground.sensorPositions()
+        rs = numpy.where(numpy.arange(n) % 2 == 0, 0.01, 0.04).astype(ps.dtype)
+        qs = numpy.asarray(qs, dtype=ps.dtype)
+        self.assertEqual(self._estimator._countTargets(ps, rs, qs).tolist(),
+                         countAll(ps, rs * rs, qs).tolist())
+
+
+    def testGridCounts(self):
+        '''Test counting many targets using a grid gives the same counts.'''
+        rng = numpy.random.default_rng(3)
+        n = EulerEstimator.KDTREE_THRESHOLD
+        ps = rng.random((n, 2))
+        rs = 0.05 + rng.random(n) * 0.05
+        qs = rng.random((500, 2)) * 1.2 - 0.1
+        cs = self._estimator._countTargets(ps, rs, qs)
+        self.assertEqual(cs.tolist(), countAll(ps, rs * rs, qs).tolist())
+
+
+    def testGridCountsFarTargets(self):
+        '''Test counting with a grid ignores targets far from all the sensors.'''
+        rng = numpy.random.default_rng(4)
+        ps = rng.random((60, 3))
+        rs = numpy.full(60, 0.01)
+        qs = numpy.vstack([ps[:10] + 0.005, [[1e5, 1e5, 1e5], [-1e9, 0.5, 0.5]]])
+        cs = self._estimator._countTargets(ps, rs, qs)
+        self.assertEqual(cs.tolist(), countAll(ps, rs * rs, qs).tolist())
+
+        # sensors spread too far apart to grid
+        ps[0] = [1e9, 1e9, 1e9]
+        cs = self._estimator._countTargets(ps, rs, qs)
+        self.assertEqual(cs.tolist(), countAll(ps, rs * rs, qs).tolist())
+
+
+    def testGridCountsZeroRadii(self):
+        '''Test sensors with zero radii count no targets.'''
+        rng = numpy.random.default_rng(5)
+        ps = rng.random((60, 2))
+        with numpy.errstate(all='raise'):
+            cs = self._estimator._countTargets(ps, numpy.zeros(60), ps)
+        self.assertEqual(cs.tolist(), [0] * 60)
+
+
 if __name__ == '__main__':
     unittest.main()
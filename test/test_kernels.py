@@ -0,0 +1,259 @@
+# Test compiled kernels
+#
+# Copyright (C) 2024 Simon Dobson
+#
+# This file is part of target-counting, an experiment in
+# target counting and higher-order sensor data analytics
+#
+# This is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This software is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this software. If not, see <http://www.gnu.org/licenses/gpl.html>.
+
+import unittest
+import numpy
+from sensorplayground import *
+from sensorplayground import kernels
+
+
+class TestDetectAll(unittest.TestCase):
+
+    def setUp(self):
+        self._ps = numpy.asarray([[0.0, 0.0], [1.0, 1.0], [0.5, 0.0]], dtype=numpy.float32)
+        self._r2s = numpy.asarray([0.25, 0.01, 1.0], dtype=numpy.float32)
+        self._qs = numpy.asarray([[0.1, 0.1], [1.0, 1.05], [2.0, 2.0]], dtype=numpy.float32)
+        self._expected = [[True, False, False],
+                          [False, True, False],
+                          [True, False, False]]
+
+
+    def testDetectAll(self):
+        '''Test we get the right detection matrix.'''
+        ds = detectAll(self._ps, self._r2s, self._qs)
+        self.assertEqual(ds.shape, (3, 3))
+        self.assertEqual(ds.tolist(), self._expected)
+
+
+    def testDetectAllNumpy(self):
+        '''Test the numpy fallback gives the same answers.'''
+        ds = kernels._detectAllNumpy(self._ps, self._r2s, self._qs)
+        self.assertEqual(ds.tolist(), self._expected)
+
+
+    def testCountAll(self):
+        '''Test we count the targets detected by each sensor.'''
+        cs = [sum(r) for r in self._expected]
+        self.assertEqual(countAll(self._ps, self._r2s, self._qs).tolist(), cs)
+        self.assertEqual(kernels._countAllNumpy(self._ps, self._r2s, self._qs).tolist(), cs)
+
+
+    def testCountAllThreaded(self):
+        '''Test we get the same counts when targets are split across threads.'''
+        rng = numpy.random.default_rng(1)
+        qs = rng.random((1000, 2)).astype(numpy.float32)
+        cs = detectAll(self._ps, self._r2s, qs).sum(axis=1).tolist()
+        n = kernels.THREAD_TARGETS
+        try:
+            kernels.THREAD_TARGETS = 100
+            self.assertEqual(kernels._countAllNumpy(self._ps, self._r2s, qs).tolist(), cs)
+        finally:
+            kernels.THREAD_TARGETS = n
+
+
+    def testDimensions(self):
+        '''Test we get the same answers in all dimensions.'''
+        rng = numpy.random.default_rng(2)
+        for d in [1, 2, 3, 4]:
+            ps = rng.random((5, d))
+            r2s = rng.random(5) * 0.25
+            qs = rng.random((20, d))
+            ds = kernels._detectAllNumpy(ps, r2s, qs)
+            self.assertEqual(detectAll(ps, r2s, qs).tolist(), ds.tolist())
+            self.assertEqual(countAll(ps, r2s, qs).tolist(), ds.sum(axis=1).tolist())
+
+
+    def testNaNSensors(self):
+        '''Test sensors without positions or radii detect nothing, as in numpy.'''
+        ps = numpy.copy(self._ps)
+        r2s = numpy.copy(self._r2s)
+        ps[1] = numpy.nan
+        r2s[2] = numpy.nan
+        ds = kernels._detectAllNumpy(ps, r2s, self._qs)
+        self.assertEqual(ds.tolist(), [[True, False, False],
+                                       [False, False, False],
+                                       [False, False, False]])
+        self.assertEqual(detectAll(ps, r2s, self._qs).tolist(), ds.tolist())
+        self.assertEqual(countAll(ps, r2s, self._qs).tolist(), [1, 0, 0])
+        self.assertEqual(kernels._countAllNumpy(ps, r2s, self._qs).tolist(), [1, 0, 0])
+
+
+    def testFarFromOrigin(self):
+        '''Test we detect targets close to the boundary far from the origin.'''
+        rng = numpy.random.default_rng(5)
+        ps = (1000.0 + rng.random((10, 2))).astype(numpy.float32)
+        r2s = numpy.ones(10, dtype=numpy.float32)
+        th = rng.random(50) * 2 * numpy.pi
+        qs = (ps[0] + 0.99 * numpy.column_stack((numpy.cos(th), numpy.sin(th)))).astype(numpy.float32)
+        ds = [withinRadius(p, r2, qs).tolist() for (p, r2) in zip(ps, r2s)]
+        self.assertTrue(all(ds[0]))
+        self.assertEqual(kernels._detectAllNumpy(ps, r2s, qs).tolist(), ds)
+        self.assertEqual(detectAll(ps, r2s, qs).tolist(), ds)
+        self.assertEqual(kernels._countAllNumpy(ps, r2s, qs).tolist(), [sum(d) for d in ds])
+
+
+    def testNoTargets(self):
+        '''Test we handle an empty set of targets.'''
+        qs = numpy.empty((0, 2), dtype=numpy.float32)
+        ds = detectAll(self._ps, self._r2s, qs)
+        self.assertEqual(ds.shape, (3, 0))
+        self.assertEqual(countAll(self._ps, self._r2s, qs).tolist(), [0, 0, 0])
+
+
+class TestWithinRadius(unittest.TestCase):
+
+    def testWithinRadius(self):
+        '''Test we find the targets strictly within a sensor's radius.'''
+        p = numpy.asarray([1.0, 1.0])
+        qs = numpy.asarray([[1.0, 1.0], [1.2, 1.2], [1.5, 1.0], [2.0, 2.0]])
+        expected = [True, True, False, False]
+        self.assertEqual(withinRadius(p, 0.25, qs).tolist(), expected)
+        self.assertEqual(kernels._withinRadiusNumpy(p, 0.25, qs).tolist(), expected)
+        self.assertEqual(withinRadius(p, 0.25, numpy.empty((0, 2))).tolist(), [])
+
+
+class TestOverlapMatrix(unittest.TestCase):
+
+    def testOverlaps(self):
+        '''Test we find overlapping pairs of sensors.'''
+        ps = numpy.asarray([[0.25, 0.25], [0.25, 0.35], [0.25, 0.75], [0.25, 0.45]])
+        rs = numpy.asarray([0.1, 0.1, 0.1, 0.05])
+        expected = [[False, True, False, False],
+                    [True, False, False, True],
+                    [False, False, False, False],
+                    [False, True, False, False]]
+        self.assertEqual(overlapMatrix(ps, rs).tolist(), expected)
+        self.assertEqual(kernels._overlapMatrixNumpy(ps, rs).tolist(), expected)
+
+
+    def testNaNSensors(self):
+        '''Test sensors without positions don't overlap anything, as in numpy.'''
+        ps = numpy.asarray([[0.25, 0.25], [numpy.nan, numpy.nan], [0.25, 0.35]])
+        rs = numpy.asarray([0.1, 0.1, 0.1])
+        expected = [[False, False, True],
+                    [False, False, False],
+                    [True, False, False]]
+        self.assertEqual(overlapMatrix(ps, rs).tolist(), expected)
+        self.assertEqual(kernels._overlapMatrixNumpy(ps, rs).tolist(), expected)
+
+
+    def testTouching(self):
+        '''Test sensors whose fields just touch don't overlap.'''
+        ps = numpy.asarray([[0.0, 0.0], [1.0, 0.0]])
+        rs = numpy.asarray([0.5, 0.5])
+        self.assertFalse(overlapMatrix(ps, rs).any())
+
+
+@unittest.skipIf(kernels._kernels is None, 'kernels not compiled ahead of time')
+class TestAOTKernels(unittest.TestCase):
+
+    def testSameAnswers(self):
+        '''Test the ahead-of-time compiled kernels agree with numpy and with the JIT-compiled kernels.'''
+        rng = numpy.random.default_rng(4)
+        for t in [numpy.float32, numpy.float64]:
+            for d in [2, 3]:
+                ps = rng.random((10, d)).astype(t)
+                ps[3] = numpy.nan
+                r2s = (rng.random(10) * 0.25).astype(t)
+                qs = rng.random((30, d)).astype(t)
+                rs = (rng.random(10) * 0.25).astype(t)
+                ds = kernels._detectAllNumpy(ps, r2s, qs)
+                m = kernels._overlapMatrixNumpy(ps, rs)
+
+                k = kernels._aotKernel(f'detectAll{d}', 0, ps, r2s, qs)
+                self.assertEqual(k(ps, r2s, qs).tolist(), ds.tolist())
+                k = kernels._aotKernel(f'countAll{d}', 0, ps, r2s, qs)
+                self.assertEqual(k(ps, r2s, qs).tolist(), ds.sum(axis=1).tolist())
+                k = kernels._aotKernel('overlapMatrix', 0, ps, rs)
+                self.assertEqual(k(ps, rs).tolist(), m.tolist())
+
+                if kernels.HAVE_NUMBA:
+                    k = getattr(kernels, f'_detectAll{d}Numba')
+                    self.assertEqual(k(ps, r2s, qs).tolist(), ds.tolist())
+                    k = getattr(kernels, f'_countAll{d}Numba')
+                    self.assertEqual(k(ps, r2s, qs).tolist(), ds.sum(axis=1).tolist())
+                    self.assertEqual(kernels._overlapMatrixNumba(ps, rs).tolist(), m.tolist())
+
+
+class TestSensorArray(unittest.TestCase):
+
+    def setUp(self):
+        self._playground = SensorPlayground()
+
+
+    def testCounts(self):
+        '''Test we count targets at all sensors at once.'''
+        ss = []
+        for p in [[0.0, 0.0], [1.0, 1.0]]:
+            a = Agent()
+            self._playground.addAgent(a)
+            ss.append(SimpleTargetCountSensor(a, r=0.5))
+            a.setPosition(p)
+        sa = SensorArray(ss)
+
+        self.assertEqual(len(sa), 2)
+        self.assertEqual(sa.counts([[0.1, 0.1], [0.2, 0.0], [0.9, 0.9]]).tolist(), [2, 1])
+        self.assertEqual(sa.counts([]).tolist(), [0, 0])
+
+
+    def testDetectsAlongTrajectories(self):
+        '''Test we detect moving targets in one pass.'''
+        ss = []
+        for p in [[0.0, 0.0], [1.0, 1.0]]:
+            a = Agent()
+            self._playground.addAgent(a)
+            ss.append(SimpleTargetCountSensor(a, r=0.5))
+            a.setPosition(p)
+        sa = SensorArray(ss)
+        js = [Trajectory([0.0, 0.0], 0.0, [1.0, 1.0], 1.0),
+              Trajectory([2.0, 0.0], 0.5, [2.0, 2.0], 1.5)]
+        ja = TrajectoryArray(js)
+
+        for t in [0.0, 0.25, 0.5, 0.75, 1.0]:
+            ds = sa.detectsAt(ja, t)
+            qs = [j.positionAt(min(max(t, j.interval()[0]), j.interval()[1])) for j in js]
+            self.assertEqual(ds.tolist(), sa.detects(qs).tolist())
+            self.assertEqual(ds.tolist(),
+                             kernels._advanceAndDetectNumpy(t, *ja.arrays(),
+                                                            sa.positions(), sa.squaredRadii()).tolist())
+        self.assertEqual(sa.detectsAt(ja, 0.0).tolist(), [[True, False], [False, False]])
+        self.assertEqual(sa.detectsAt(ja, 1.0).tolist(), [[False, False], [True, False]])
+
+
+
+    def testDetectsAlongTrajectoriesLate(self):
+        '''Test we detect moving targets at large simulation times.'''
+        a = Agent()
+        self._playground.addAgent(a)
+        s = SimpleTargetCountSensor(a, r=0.5)
+        a.setPosition([5.0, 0.0])
+        sa = SensorArray([s])
+        for t0 in [1e5, 2e7]:
+            j = Trajectory([0.0, 0.0], t0, [10.0, 0.0], t0 + 1)
+            ja = TrajectoryArray([j])
+            for dt in [0.3, 0.5]:
+                numpy.testing.assert_allclose(ja.positionsAt(t0 + dt)[0], j.positionAt(t0 + dt), atol=1e-5)
+            self.assertEqual(sa.detectsAt(ja, t0 + 0.5).tolist(), [[True]])
+            self.assertEqual(kernels._advanceAndDetectNumpy(t0 + 0.5, *ja.arrays(),
+                                                            sa.positions(), sa.squaredRadii()).tolist(), [[True]])
+            self.assertEqual(sa.detectsAt(ja, t0 + 0.3).tolist(), [[False]])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -19,6 +19,7 @@
 # along with this software. If not, see <http://www.gnu.org/licenses/gpl.html>.
 
 import unittest
+import numpy
 from sensorplayground import *
 
 
@@ -136,6 +137,134 @@ class TestPlayground(unittest.TestCase):
         self.assertIsNotNone(b.eventTime)
 
 
+    # ---------- Proximity ----------
+
+    def testWithinDistance(self):
+        '''Test we find agents within a distance, with and without the k-d tree.'''
+        ps = [[0.0, 0.0], [0.5, 0.0], [1.0, 0.0], [0.0, 2.0]]
+        as_ = []
+        for p in ps:
+            a = Agent()
+            self._playground.addAgent(a)
+            a.setPosition(p)
+            as_.append(a)
+
+        for threshold in [SensorPlayground.KDTREE_THRESHOLD, 1]:
+            self._playground.KDTREE_THRESHOLD = threshold
+            self._playground.setAgentBoundingBox(as_[0], BoundingBox(ps[0]))   # force a rebuild
+            self.assertCountEqual(self._playground.allAgentsWithinDistance([0.0, 0.0], 1.0),
+                                  as_[:3])
+            self.assertCountEqual(self._playground.allAgentsWithinDistance([0.0, 1.5], 0.6),
+                                  [as_[3]])
+            self.assertCountEqual(self._playground.allAgentsWithinDistance([5.0, 5.0], 1.0),
+                                  [])
+            self.assertCountEqual(self._playground.allAgentsWithinDistance([0.0, 0.0], 1.0, cls=DummyAgent),
+                                  [])
+
+
+    def testSensorsObserving(self):
+        '''Test we find the sensors that can observe an agent.'''
+        ss = []
+        for p in [[0.0, 0.0], [1.0, 0.0], [3.0, 0.0]]:
+            a = Agent()
+            self._playground.addAgent(a)
+            ss.append(SimpleTargetCountSensor(a, r=1.0))
+            a.setPosition(p)
+        t = Agent()
+        self._playground.addAgent(t)
+        t.setPosition([0.5, 0.0])
+
+        self.assertCountEqual(self._playground.allSensorsObserving(t), ss[:2])
+        self.assertCountEqual(self._playground.allSensorsObserving(t, cls=TargetCount), ss[:2])
+        self.assertCountEqual(self._playground.allSensorsObserving(t, cls=DummyAgent), [])
+        t.setPosition([2.0, 0.0])
+        self.assertCountEqual(self._playground.allSensorsObserving(t), [])
+
+
+    def testSensorsObservingTree(self):
+        '''Test we find observing sensors using the k-d tree.'''
+        n = SensorPlayground.KDTREE_THRESHOLD + 10
+        ss = []
+        for i in range(n):
+            a = Agent()
+            self._playground.addAgent(a)
+            ss.append(SimpleTargetCountSensor(a, r=0.6 if i % 2 == 0 else 0.4))
+            a.setPosition([float(i), 0.0])
+        t = Agent()
+        self._playground.addAgent(t)
+        t.setPosition([10.5, 0.0])
+        self.assertCountEqual(self._playground.allSensorsObserving(t), [ss[10]])
+
+        # moving a sensor updates the tree
+        ss[20].agent().setPosition([10.7, 0.0])
+        self.assertCountEqual(self._playground.allSensorsObserving(t), [ss[10], ss[20]])
+
+
+    # ---------- Sensor arrays ----------
+
+    def testSensorArrays(self):
+        '''Test the sensor arrays track sensors and their positions.'''
+        a = Agent()
+        b = Agent()
+        self._playground.addAgent(a)
+        self._playground.addAgent(b)
+        s1 = SimpleTargetCountSensor(a, r=0.5)
+        a.setPosition([1.0, 2.0])
+        self.assertEqual(self._playground.allSensors(), [s1])
+        self.assertEqual(self._playground.sensorPositions().tolist(), [[1.0, 2.0]])
+        self.assertEqual(self._playground.sensorRadii().tolist(), [0.5])
+        self.assertEqual(self._playground.sensorSquaredRadii().tolist(), [0.25])
+
+        # adding a sensor extends the arrays
+        s2 = SimpleTargetCountSensor(b, r=0.25)
+        b.setPosition([3.0, 3.0])
+        self.assertCountEqual(self._playground.allSensorsWithModality(TargetCount), [s1, s2])
+        i = self._playground.sensorIndex(s2)
+        self.assertEqual(self._playground.sensorPositions()[i].tolist(), [3.0, 3.0])
+        self.assertEqual(self._playground.sensorRadii()[i], 0.25)
+
+        # moving an agent updates its sensors' positions in place
+        ps = self._playground.sensorPositions()
+        b.setPosition([4.0, 4.0])
+        self.assertIs(self._playground.sensorPositions(), ps)
+        self.assertEqual(ps[i].tolist(), [4.0, 4.0])
+        self.assertEqual(self._playground.sensorSquaredNorms()[i], 32.0)
+
+        # removing a sensor removes it from the arrays
+        b.removeSensor(s2)
+        self.assertEqual(self._playground.allSensors(), [s1])
+
+
+    def testSensorArraysPrecision(self):
+        '''Test the sensor arrays are single-precision unless asked otherwise.'''
+        self.assertEqual(self._playground.sensorPositions().dtype, numpy.float32)
+        pg = SensorPlayground(dtype=numpy.float64)
+        a = Agent()
+        pg.addAgent(a)
+        SimpleTargetCountSensor(a, r=0.1)
+        a.setPosition([0.1, 0.2])
+        self.assertEqual(pg.sensorPositions().dtype, numpy.float64)
+        self.assertEqual(pg.sensorPositions().tolist(), [[0.1, 0.2]])
+
+
+    def testSensorArraysGrow(self):
+        '''Test the sensor arrays grow as sensors are added.'''
+        n = 2 * SensorPlayground.SENSOR_ARRAYS_CAPACITY + 1
+        ss = []
+        for i in range(n):
+            a = Agent()
+            self._playground.addAgent(a)
+            ss.append(SimpleTargetCountSensor(a, r=i))
+            a.setPosition([float(i), 0.0])
+        self.assertEqual(self._playground.sensorPositions().shape, (n, 2))
+        for (i, s) in enumerate(ss):
+            j = self._playground.sensorIndex(s)
+            self.assertEqual(self._playground.sensorPositions()[j].tolist(), [float(i), 0.0])
+            self.assertEqual(self._playground.sensorRadii()[j], i)
+            self.assertEqual(self._playground.sensorSquaredNorms()[j], i * i)
+            self.assertEqual(self._playground.sensorSquaredRadii()[j], i * i)
+
+
     # ---------- Simulation ----------
 
     def testPostTimes(self):
@@ -160,3 +289,59 @@ class TestPlayground(unittest.TestCase):
         self.assertEqual(nev, 2)
         self.assertIsNotNone(a.eventTime)
         self.assertIsNotNone(b.eventTime)
+
+
+    def testBatchedSamples(self):
+        '''Test sensors sampling at the same time count their targets together.'''
+        ss = []
+        for p in [[0.0, 0.0], [1.0, 0.0], [3.0, 0.0]]:
+            a = Agent()
+            self._playground.addAgent(a)
+            ss.append(SimpleTargetCountSensor(a, r=1.0, cls=DummyAgent))
+            a.setPosition(p)
+        for p in [[0.5, 0.0], [0.9, 0.0], [2.5, 0.0], [2.0, 0.0]]:
+            t = DummyAgent()
+            self._playground.addAgent(t)
+            t.setPosition(p)
+
+        self.assertEqual(SimpleTargetCountSensor.countAllTargets(ss).tolist(), [2, 2, 1])
+        for s in ss:
+            self._playground.postEvent(s, 0.5, s.sample)
+        nev = self._playground.run()
+        self.assertEqual(nev, 7)
+        self.assertEqual([s.numberOfTargets() for s in ss], [2, 2, 1])
+
+        # an unpositioned sensor sampling alongside a positioned one detects nothing
+        a = Agent()
+        self._playground.addAgent(a)
+        u = SimpleTargetCountSensor(a, r=1.0, cls=DummyAgent)
+        for s in [ss[0], u]:
+            self._playground.postEvent(s, 1.0, s.sample)
+        self._playground.run()
+        self.assertEqual(ss[0].numberOfTargets(), 2)
+        self.assertEqual(u.numberOfTargets(), 0)
+
+
+    def testBatchedSamplesMatch(self):
+        '''Test batched counts match those sensors make for themselves.'''
+        class FussySensor(SimpleTargetCountSensor):
+            def detectsTarget(self, t):
+                return isinstance(t, DummyAgent)
+
+        rng = numpy.random.default_rng(6)
+        ss = []
+        for i in range(20):
+            a = DummyAgent() if i % 3 == 0 else Agent()
+            self._playground.addAgent(a)
+            cls = [SimpleTargetCountSensor, FussySensor][i % 2]
+            ss.append(cls(a, r=0.1 + rng.random() * 0.2))
+            a.setPosition(rng.random(2).tolist())
+        for i in range(30):
+            t = DummyAgent()
+            self._playground.addAgent(t)
+            t.setPosition(rng.random(2).tolist())
+
+        cs = SimpleTargetCountSensor.countAllTargets(ss)
+        for (s, c) in zip(ss, cs):
+            s.sample(0.0)
+            self.assertEqual(c, s.numberOfTargets())
@@ -19,11 +19,45 @@
 # along with this software. If not, see <http://www.gnu.org/licenses/gpl.html>.
 
 import unittest
+import numpy
 from sensorplayground import *
 
 
 class TestPositions(unittest.TestCase):
 
+    # ---------- Helpers ----------
+
+    def testVectorPosition(self):
+        '''Test we convert positions to vectors, without copying vectors.'''
+        v = vectorPosition([1, 2])
+        self.assertIsInstance(v, numpy.ndarray)
+        self.assertEqual(v.dtype, numpy.float64)
+        self.assertEqual(v.tolist(), [1.0, 2.0])
+        self.assertEqual(vectorPosition((1.0, 2.0)).tolist(), [1.0, 2.0])
+        self.assertIs(vectorPosition(v), v)
+
+
+    def testDistances(self):
+        '''Test distances in different dimensions.'''
+        self.assertAlmostEqual(distanceBetween([0.0, 0.0], [3.0, 4.0]), 5.0)
+        self.assertAlmostEqual(distanceBetween([1.0, 2.0, 3.0], [2.0, 4.0, 5.0]), 3.0)
+        self.assertAlmostEqual(distanceBetween([1.0], [3.0]), 2.0)
+        self.assertAlmostEqual(distanceBetween([1.0, 1.0, 1.0, 1.0], [2.0, 2.0, 2.0, 2.0]), 2.0)
+        self.assertAlmostEqual(distanceBetween(numpy.asarray([0.0, 0.0]), [3.0, 4.0]), 5.0)
+        with self.assertRaises(ValueError):
+            distanceBetween([0.0, 0.0], [1.0, 1.0, 1.0])
+
+
+    def testSquaredDistances(self):
+        '''Test squared distances in different dimensions.'''
+        self.assertEqual(distanceSquaredBetween([0.0, 0.0], [3.0, 4.0]), 25.0)
+        self.assertEqual(distanceSquaredBetween([1.0, 2.0, 3.0], [2.0, 4.0, 5.0]), 9.0)
+        self.assertEqual(distanceSquaredBetween([1.0], [3.0]), 4.0)
+        self.assertEqual(distanceSquaredBetween([1.0, 1.0, 1.0, 1.0], [2.0, 2.0, 2.0, 2.0]), 4.0)
+        with self.assertRaises(ValueError):
+            distanceSquaredBetween([0.0, 0.0], [1.0, 1.0, 1.0])
+
+
     # ---------- Bounding boxes ----------
 
     def testEmptyBox(self):
@@ -99,16 +133,39 @@ class TestPositions(unittest.TestCase):
         self.assertFalse(bb.contains([0.5, 0.0]))
         self.assertFalse(bb.contains([0.0, 0.0]))
 
+        # wrong dimension
+        with self.assertRaises(ValueError):
+            bb.contains([0.5, 0.5, 0.5])
+
+
+    def testContainsArray(self):
+        '''Test containment of several points at once.'''
+        bb = BoundingBox([0.0, 0.0], [1.0, 1.0])
+        ps = numpy.asarray([[0.1, 0.1], [0.0, 0.5], [0.5, 0.5], [1.1, 0.5]])
+        self.assertEqual(bb.contains(ps).tolist(), [True, False, True, False])
+        self.assertEqual(bb.contains(numpy.empty((0, 2))).tolist(), [])
+
+        # zero-depth dimension
+        b2 = BoundingBox([0.0, 0.5], [1.0, 0.5])
+        ps = numpy.asarray([[0.5, 0.5], [0.5, 0.6]])
+        self.assertEqual(b2.contains(ps).tolist(), [True, False])
+
+        # wrong dimension
+        with self.assertRaises(ValueError):
+            bb.contains(numpy.zeros((2, 3)))
+
 
     def testPoint(self):
         '''Test we can create bounding boxes that are single points.'''
         b1 = BoundingBox([0.0, 0.0])
-        self.assertEqual(b1.corners(), ([0.0, 0.0], [0.0, 0.0]))
+        self.assertEqual([c.tolist() for c in b1.corners()], [[0.0, 0.0], [0.0, 0.0]])
+        self.assertTrue(b1.isPoint())
         self.assertTrue(b1.contains([0.0, 0.0]))
 
         b2 = BoundingBox([0.0, 0.0], [0.0, 0.0])
-        self.assertEqual(b1.corners(), ([0.0, 0.0], [0.0, 0.0]))
-        self.assertTrue(b1.contains([0.0, 0.0]))
+        self.assertEqual([c.tolist() for c in b2.corners()], [[0.0, 0.0], [0.0, 0.0]])
+        self.assertTrue(b2.isPoint())
+        self.assertTrue(b2.contains([0.0, 0.0]))
 
 
     def testUnion(self):
@@ -118,25 +175,25 @@ class TestPositions(unittest.TestCase):
         b1 = BoundingBox([0.0, 0.0], [1.0, 1.0])
         b2 = BoundingBox([0.0, 0.0], [1.0, 1.0])
         bu = b1.union(b2)
-        self.assertCountEqual(b1.corners(), bu.corners())
+        self.assertEqual([c.tolist() for c in bu.corners()], [c.tolist() for c in b1.corners()])
 
         # extending box
         b1 = BoundingBox([0.0, 0.0], [1.0, 1.0])
         b2 = BoundingBox([0.5, 0.5], [1.5, 1.5])
         bu = b1.union(b2)
-        self.assertCountEqual(bu.corners(), ([0.0, 0.0], [1.5, 1.5]))
+        self.assertEqual([c.tolist() for c in bu.corners()], [[0.0, 0.0], [1.5, 1.5]])
 
         # non-intersecting boxes
         b1 = BoundingBox([0.0, 0.0], [1.0, 1.0])
         b2 = BoundingBox([1.5, 1.5], [2.5, 2.5])
         bu = b1.union(b2)
-        self.assertCountEqual(bu.corners(), ([0.0, 0.0], [2.5, 2.5]))
+        self.assertEqual([c.tolist() for c in bu.corners()], [[0.0, 0.0], [2.5, 2.5]])
 
         # boxes with reversed corners
         b1 = BoundingBox([0.0, 0.0], [1.0, 1.0])
         b2 = BoundingBox([1.5, 2.5], [2.5, 1.5])
         bu = b1.union(b2)
-        self.assertCountEqual(bu.corners(), ([0.0, 0.0], [2.5, 2.5]))
+        self.assertEqual([c.tolist() for c in bu.corners()], [[0.0, 0.0], [2.5, 2.5]])
 
         # mismatched dimensions
         b1 = BoundingBox([0.0, 0.0], [1.0, 1.0])
@@ -157,8 +214,8 @@ class TestTrajectories(unittest.TestCase):
         self.assertTrue(j.isWithinInterval(0.5))
         with self.assertRaises(ValueError):
             j.isWithinInterval(1.5, fatal=True)
-        self.assertEqual(j.boundingBox().corners(),
-                         ([0.0, 0.0], [1.0, 1.0]))
+        self.assertEqual([c.tolist() for c in j.boundingBox().corners()],
+                         [[0.0, 0.0], [1.0, 1.0]])
 
 
     def testPosition(self):
@@ -168,11 +225,66 @@ class TestTrajectories(unittest.TestCase):
         self.assertEqual(j.positionAt(0.5), [0.5, 0.5])
 
 
+    def testPositionLaterStart(self):
+        '''Test we interpolate correctly when the motion doesn't start at time 0.'''
+        j = Trajectory([0.0, 0.0], 1.0,
+                       [1.0, 2.0], 3.0)
+        self.assertEqual(j.positionAt(1.0), [0.0, 0.0])
+        self.assertEqual(j.positionAt(2.0), [0.5, 1.0])
+        self.assertEqual(j.positionAt(3.0), [1.0, 2.0])
+
+
+    def testAdvance(self):
+        '''Test we can advance along a trajectory.'''
+        j = Trajectory([0.0, 0.0], 0.0,
+                       [1.0, 1.0], 1.0)
+        j.advanceTo(0.5)
+        self.assertEqual(j.interval(), (0.5, 1.0))
+        self.assertEqual(j.positionAt(0.5), [0.5, 0.5])
+        self.assertEqual(j.positionAt(0.75), [0.75, 0.75])
+        self.assertEqual(j.positionAt(1.0), [1.0, 1.0])
+        with self.assertRaises(ValueError):
+            j.positionAt(0.25)
+
+
     def testEnterExit(self):
         '''Test the simple enter-exit scenario.'''
         j = Trajectory([0.0, 0.5], 0.0,
                        [1.0, 0.5], 1.0)
         bb = BoundingBox([0.25, 0.25], [0.75, 0.75])
-        ee = j.entersLeavesAt(bb)
-        print(ee)
-        self.assertTrue(True)
+        self.assertEqual(j.entersLeavesAt(bb), (0.25, 0.75))
+
+
+    def testEnterExitDiagonal(self):
+        '''Test entering and leaving across different sides.'''
+        j = Trajectory([0.0, 0.0], 1.0,
+                       [1.0, 2.0], 3.0)
+        bb = BoundingBox([0.25, 0.0], [0.75, 1.0])
+        (te, tl) = j.entersLeavesAt(bb)
+        self.assertAlmostEqual(te, 1.5)
+        self.assertAlmostEqual(tl, 2.0)
+
+
+    def testEnterExitClipped(self):
+        '''Test trajectories starting or ending inside the box.'''
+        bb = BoundingBox([0.25, 0.25], [0.75, 0.75])
+        j = Trajectory([0.5, 0.5], 0.0,
+                       [1.0, 0.5], 1.0)
+        self.assertEqual(j.entersLeavesAt(bb), (0.0, 0.5))
+        j = Trajectory([0.5, 0.5], 0.0,
+                       [0.6, 0.6], 1.0)
+        self.assertEqual(j.entersLeavesAt(bb), (0.0, 1.0))
+
+
+    def testEnterExitMiss(self):
+        '''Test trajectories that never enter the box.'''
+        bb = BoundingBox([0.25, 0.25], [0.75, 0.75])
+        j = Trajectory([0.0, 0.0], 0.0,
+                       [0.0, 1.0], 1.0)
+        self.assertIsNone(j.entersLeavesAt(bb))
+        j = Trajectory([0.0, 0.0], 0.0,
+                       [1.0, 0.1], 1.0)
+        self.assertIsNone(j.entersLeavesAt(bb))
+        j = Trajectory([0.0, 0.5], 0.0,
+                       [0.2, 0.5], 1.0)
+        self.assertIsNone(j.entersLeavesAt(bb))
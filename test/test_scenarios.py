@@ -19,21 +19,35 @@
 # along with this software. If not, see <http://www.gnu.org/licenses/gpl.html>.
 
 from re import split
+import logging
 import unittest
+import numpy
 from sensorplayground import *
 
 
+logger = logging.getLogger(__name__)
+
+
 class TargetCountingTraceSensor(SimpleTargetCountSensor):
     '''A target counter that records a trace.'''
 
     def __init__(self, a = None, r = 1.0, id = None):
         super().__init__(a, r, id)
-        self._trace = []
+        self._n = 0
+        self._trace = numpy.empty(16, dtype=[('t', 'f8'), ('n', 'i8')])
 
 
     def sample(self, t):
         super().sample(t)
-        self._trace.append((t, self.numberOfTargets()))
+        if self._n == len(self._trace):
+            self._trace = numpy.resize(self._trace, 2 * len(self._trace))
+        self._trace[self._n] = (t, self.numberOfTargets())
+        self._n += 1
+
+
+    def trace(self):
+        '''Return the (t, n) samples recorded so far.'''
+        return self._trace[:self._n]
 
 
 class Target(MobileAgent):
@@ -49,9 +63,9 @@ class Tweeter(Target):
         '''Cause an observable tweet.
 
         :param t: the simulation time (ignored)'''
-        print('tweet')
+        logger.debug('tweet')
         possibleSensors = self.playground().allSensorsObserving(self, cls=Acoustic)
-        print(possibleSensors)
+        logger.debug('possible sensors: %r', possibleSensors)
         for s in possibleSensors:
             s.triggeredBy(self)
 
@@ -95,7 +109,7 @@ class TestScenarios(unittest.TestCase):
         m.moveTo([2.0, 1.5], dt=1.0)
 
         # add a sensing event for t=0.5
-        self._playground.postEvent(0.5, s, s.sample)
+        self._playground.postEvent(s, 0.5, s.sample)
 
         # run the simulation
         self._playground.run()
@@ -175,7 +189,7 @@ class TestScenarios(unittest.TestCase):
         self._playground.run()
 
         # check detection
-        self.assertCountEqual(s._trace, [(0.0, 0), (0.5, 1), (1.0, 0)])
+        self.assertCountEqual(s.trace().tolist(), [(0.0, 0), (0.5, 1), (1.0, 0)])
 
 
     def testStaticSensorTwoMovingTargetsOverTime(self):
@@ -208,7 +222,7 @@ class TestScenarios(unittest.TestCase):
         self._playground.run()
 
         # check detection
-        self.assertCountEqual(s._trace, [(0.0, 0), (0.5, 1), (0.70, 2), (1.0, 1)])
+        self.assertCountEqual(s.trace().tolist(), [(0.0, 0), (0.5, 1), (0.70, 2), (1.0, 1)])
 
 
     def testStaticTargetsDistinct(self):
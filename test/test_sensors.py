@@ -0,0 +1,106 @@
+# Test sensors
+#
+# Copyright (C) 2024 Simon Dobson
+#
+# This file is part of target-counting, an experiment in
+# target counting and higher-order sensor data analytics
+#
+# This is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This software is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this software. If not, see <http://www.gnu.org/licenses/gpl.html>.
+
+import unittest
+import numpy
+from sensorplayground import *
+
+
+class TestSimpleSensor(unittest.TestCase):
+
+    def setUp(self):
+        self._playground = SensorPlayground()
+        a = Agent()
+        self._playground.addAgent(a)
+        self._sensor = SimpleTargetCountSensor(a, r=0.5)
+        a.setPosition([1.0, 1.0])
+        self._targets = [[1.0, 1.0], [1.2, 1.2], [1.5, 1.0], [2.0, 2.0]]
+
+
+    # ---------- Position ----------
+
+    def testPositionVector(self):
+        '''Test the sensor's position is converted to a vector once.'''
+        v = self._sensor.positionVector()
+        self.assertIsInstance(v, numpy.ndarray)
+        self.assertEqual(v.tolist(), [1.0, 1.0])
+        self.assertIs(self._sensor.positionVector(), v)
+        self._sensor.agent().setPosition([2.0, 1.0])
+        self.assertEqual(self._sensor.positionVector().tolist(), [2.0, 1.0])
+
+
+    # ---------- Field of view ----------
+
+    def testFieldOfView(self):
+        '''Test the field of view follows the sensor as it moves.'''
+        fov = self._sensor.fieldOfView()
+        self.assertEqual([c.tolist() for c in fov.corners()], [[0.5, 0.5], [1.5, 1.5]])
+        self.assertIs(self._sensor.fieldOfView(), fov)
+        self._sensor.agent().setPosition([2.0, 1.0])
+        self.assertEqual([c.tolist() for c in self._sensor.fieldOfView().corners()], [[1.5, 0.5], [2.5, 1.5]])
+
+
+    # ---------- Detection ----------
+
+    def testCanDetect(self):
+        '''Test we detect targets strictly within the sensing field.'''
+        self.assertTrue(self._sensor.canDetectTarget([1.0, 1.0]))
+        self.assertTrue(self._sensor.canDetectTarget([1.2, 1.2]))
+        self.assertFalse(self._sensor.canDetectTarget([1.5, 1.0]))
+        self.assertFalse(self._sensor.canDetectTarget([2.0, 2.0]))
+
+
+    def testDetectsList(self):
+        '''Test we detect and count targets given as a list.'''
+        self.assertEqual(self._sensor.detects(self._targets), [[1.0, 1.0], [1.2, 1.2]])
+        self.assertEqual(self._sensor.counts(self._targets), 2)
+        self.assertEqual(self._sensor.counts(iter(self._targets)), 2)
+        self.assertEqual(self._sensor.counts([]), 0)
+        self.assertEqual(self._sensor.detects([]), [])
+
+
+    def testDetectsArray(self):
+        '''Test we detect and count targets given as an array.'''
+        ts = numpy.asarray(self._targets)
+        ds = self._sensor.detects(ts)
+        self.assertIsInstance(ds, numpy.ndarray)
+        self.assertEqual(ds.tolist(), [[1.0, 1.0], [1.2, 1.2]])
+        self.assertEqual(self._sensor.counts(ts), 2)
+        self.assertEqual(self._sensor.counts(numpy.empty((0, 2))), 0)
+
+
+    # ---------- Overlaps ----------
+
+    def testOverlaps(self):
+        '''Test we detect overlapping sensors.'''
+        ss = [self._sensor]
+        for p in [[1.0, 1.9], [1.0, 2.0], [3.0, 3.0]]:
+            a = Agent()
+            self._playground.addAgent(a)
+            ss.append(SimpleTargetCountSensor(a, r=0.5))
+            a.setPosition(p)
+
+        self.assertTrue(ss[0].isOverlappingWith(ss[1]))
+        self.assertFalse(ss[0].isOverlappingWith(ss[2]))     # touching
+        self.assertFalse(ss[0].isOverlappingWith(ss[3]))
+
+
+if __name__ == '__main__':
+    unittest.main()
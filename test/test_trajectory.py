@@ -19,6 +19,7 @@
 # along with this software. If not, see <http://www.gnu.org/licenses/gpl.html>.
 
 import unittest
+import numpy
 from sensorplayground import *
 
 
@@ -28,8 +29,10 @@ class TestTrajectory(unittest.TestCase):
         '''Test we detect mismatched dimensions.'''
 
         # matched
-        _ = Trajectory([1, 2, 3], 0.0, [1, 2, 6], 1.0)
-        _ = Trajectory([1, 2], 0.0, [2, 6], 1.0)
+        t = Trajectory([1, 2, 3], 0.0, [1, 2, 6], 1.0)
+        self.assertEqual(t.dimension(), 3)
+        t = Trajectory([1, 2], 0.0, [2, 6], 1.0)
+        self.assertEqual(t.dimension(), 2)
 
         # unmatched with exception
         with self.assertRaises(ValueError):
@@ -61,20 +64,20 @@ class TestTrajectory(unittest.TestCase):
         # correct order
         t = Trajectory([0, 0, 0], 0.0, [1, 1, 1], 1.0)
         (bl, tr) = t.boundingBox()
-        self.assertCountEqual(bl, [0, 0, 0])
-        self.assertCountEqual(tr, [1, 1, 1])
+        numpy.testing.assert_array_equal(bl, [0, 0, 0])
+        numpy.testing.assert_array_equal(tr, [1, 1, 1])
 
         # reversed
         t = Trajectory([1, 1, 1], 0.0, [0, 0, 0], 1.0)
         (bl, tr) = t.boundingBox()
-        self.assertCountEqual(bl, [0, 0, 0])
-        self.assertCountEqual(tr, [1, 1, 1])
+        numpy.testing.assert_array_equal(bl, [0, 0, 0])
+        numpy.testing.assert_array_equal(tr, [1, 1, 1])
 
         # mixed
         t = Trajectory([0, 0, 1], 0.0, [1, 1, 0], 1.0)
         (bl, tr) = t.boundingBox()
-        self.assertCountEqual(bl, [0, 0, 0])
-        self.assertCountEqual(tr, [1, 1, 1])
+        numpy.testing.assert_array_equal(bl, [0, 0, 0])
+        numpy.testing.assert_array_equal(tr, [1, 1, 1])
 
 
     def testWithinBoundingBox(self):
@@ -96,12 +99,12 @@ class TestTrajectory(unittest.TestCase):
         t = Trajectory([0, 0, 0], 0.0, [2, 1, 1], 1.0)
 
         # at start and end
-        self.assertCountEqual(t.position(0.0), [0.0, 0.0, 0.0])
-        self.assertCountEqual(t.position(1.0), [2.0, 1.0, 1.0])
-        self.assertCountEqual(t.position(0.8), [1.6, 0.8, 0.8])
+        numpy.testing.assert_allclose(t.position(0.0), [0.0, 0.0, 0.0], rtol=1e-12)
+        numpy.testing.assert_allclose(t.position(1.0), [2.0, 1.0, 1.0], rtol=1e-12)
+        numpy.testing.assert_allclose(t.position(0.8), [1.6, 0.8, 0.8], rtol=1e-12)
 
         # within
-        self.assertCountEqual(t.position(0.5), [1.0, 0.5, 0.5])
+        numpy.testing.assert_allclose(t.position(0.5), [1.0, 0.5, 0.5], rtol=1e-12)
 
         # outside
         with self.assertRaises(ValueError):
@@ -113,4 +116,18 @@ class TestTrajectory(unittest.TestCase):
 
         # within with a reversed direction
         t = Trajectory([1, 1, 1], 0.0, [0, 0, 0], 1.0)
-        self.assertCountEqual(t.position(0.5), [0.5, 0.5, 0.5])
+        numpy.testing.assert_allclose(t.position(0.5), [0.5, 0.5, 0.5], rtol=1e-12)
+
+
+    def testPositions(self):
+        '''Test interpolating several positions at once.'''
+        t = Trajectory([0, 0, 0], 0.0, [2, 1, 1], 1.0)
+        ts = [0.0, 0.5, 0.8, 1.0]
+        ps = t.positions(ts)
+        self.assertEqual(ps.shape, (4, 3))
+        numpy.testing.assert_allclose(ps, [t.position(tau) for tau in ts], rtol=1e-12)
+        self.assertEqual(t.positions([]).shape, (0, 3))
+
+        # outside
+        with self.assertRaises(ValueError):
+            t.positions([0.5, 1.1])